@@ -0,0 +1,118 @@
+import asyncio
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+from execution import DeviceExecutor, QueueFull
+
+
+@dataclass
+class BatchItem:
+    payload: Any
+    num_tokens: int
+    future: asyncio.Future
+
+
+@dataclass
+class BatchStats:
+    requests: int = 0
+    batches: int = 0
+    max_batch_size: int = 0
+    last_batch_size: int = 0
+    # histogram of achieved batch sizes
+    batch_sizes: dict[int, int] = field(default_factory=dict)
+
+    @property
+    def mean_batch_size(self) -> float:
+        return self.requests / self.batches if self.batches else 0.0
+
+
+class BatchScheduler:
+    """
+    Collects requests for one model and runs them together: a batch is started
+    by the first waiting request and closed after max_wait seconds, or earlier
+    once max_batch_size requests are in it or the next request would push the
+    padded batch (size x longest input) past max_batch_tokens. run_batch gets
+    the payloads of a batch and returns one result per payload, which are
+    handed back to the awaiting submit calls. It runs on executor, if given.
+    Once max_queue requests are waiting, submit raises QueueFull.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[list[Any]], list[Any]],
+        max_wait: float = 0.005,
+        max_batch_size: int = 16,
+        max_batch_tokens: int = 8192,
+        executor: Optional[DeviceExecutor] = None,
+        max_queue: int = 256,
+    ):
+        self.run_batch = run_batch
+        self.max_wait = max_wait
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.executor = executor
+        self.max_queue = max_queue
+        self.queue: asyncio.Queue[BatchItem] = asyncio.Queue()
+        # a request that didn't fit into the previous batch starts the next one
+        self.carry: Optional[BatchItem] = None
+        self.task: Optional[asyncio.Task] = None
+        self.stats = BatchStats()
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize() + (self.carry is not None)
+
+    async def submit(self, payload: Any, num_tokens: int) -> Any:
+        if self.queue_depth >= self.max_queue:
+            raise QueueFull("too many requests waiting")
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(BatchItem(payload, num_tokens, future))
+        return await future
+
+    async def collect(self) -> list[BatchItem]:
+        loop = asyncio.get_running_loop()
+        if self.carry is not None:
+            batch, self.carry = [self.carry], None
+        else:
+            batch = [await self.queue.get()]
+        longest = batch[0].num_tokens
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if (len(batch) + 1) * max(longest, item.num_tokens) > self.max_batch_tokens:
+                self.carry = item
+                break
+            batch.append(item)
+            longest = max(longest, item.num_tokens)
+        return batch
+
+    async def run(self):
+        while True:
+            batch = await self.collect()
+            self.stats.requests += len(batch)
+            self.stats.batches += 1
+            self.stats.last_batch_size = len(batch)
+            self.stats.max_batch_size = max(self.stats.max_batch_size, len(batch))
+            self.stats.batch_sizes[len(batch)] = self.stats.batch_sizes.get(len(batch), 0) + 1
+            payloads = [item.payload for item in batch]
+            try:
+                if self.executor is not None:
+                    results = await self.executor.run(self.run_batch, payloads, bounded=False)
+                else:
+                    results = self.run_batch(payloads)
+            except Exception as e:
+                for item in batch:
+                    if not item.future.done():
+                        item.future.set_exception(e)
+                continue
+            for item, result in zip(batch, results):
+                if not item.future.done():
+                    item.future.set_result(result)
@@ -0,0 +1,44 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable
+
+
+class QueueFull(Exception):
+    pass
+
+
+@dataclass
+class ExecutorStats:
+    pending: int = 0
+    completed: int = 0
+    rejected: int = 0
+
+
+class DeviceExecutor:
+    """
+    Runs blocking model work for one device in a dedicated worker thread, so
+    the event loop stays free while the device is busy. Work on a device is
+    serialized; at most max_pending calls may wait for it.
+
+    Grad mode, autocast and the current cuda stream are thread-local, so the
+    functions have to enter them themselves.
+    """
+
+    def __init__(self, name: str, max_pending: int = 64):
+        self.name = name
+        self.max_pending = max_pending
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"device-{name}")
+        self.stats = ExecutorStats()
+
+    async def run(self, fn: Callable[..., Any], *args: Any, bounded: bool = True) -> Any:
+        # the schedulers bound their own queues and always get through
+        if bounded and self.stats.pending >= self.max_pending:
+            self.stats.rejected += 1
+            raise QueueFull(f"too many requests waiting for {self.name}")
+        self.stats.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.pool, fn, *args)
+        finally:
+            self.stats.pending -= 1
+            self.stats.completed += 1
@@ -0,0 +1,243 @@
+import asyncio
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Optional
+
+import torch
+
+from execution import DeviceExecutor
+from gpt import GPT, KVCache
+
+
+@dataclass
+class GenerationStats:
+    steps: int = 0
+    # rows decoded over all steps
+    rows: int = 0
+    tokens: int = 0
+    sequences: int = 0
+    max_batch_size: int = 0
+
+    @property
+    def mean_batch_size(self) -> float:
+        return self.rows / self.steps if self.steps else 0.0
+
+
+@dataclass
+class Sequence:
+    tokens: list[int]
+    max_new_tokens: int
+    temperature: float
+    top_k: int
+    # sampled on the worker thread
+    generated: int = 0
+    done: bool = False
+    # handed to the consumer on the event loop, but not yet picked up
+    pending: list[int] = field(default_factory=list)
+    ready: asyncio.Event = field(default_factory=asyncio.Event)
+    delivered: int = 0
+    cancelled: bool = False
+    # set if generating failed, raised to the consumer
+    error: Optional[BaseException] = None
+
+    def sample(self, token: int, emitted: list[tuple["Sequence", int]]):
+        self.generated += 1
+        self.done = self.generated == self.max_new_tokens
+        emitted.append((self, token))
+
+    def deliver(self, token: int):
+        self.pending.append(token)
+        self.delivered += 1
+        self.ready.set()
+
+    def fail(self, error: BaseException):
+        self.error = error
+        self.ready.set()
+
+    @property
+    def finished(self) -> bool:
+        return self.delivered == self.max_new_tokens
+
+
+class GenerationEngine:
+    """
+    Continuous batching for one model: all running sequences are decoded
+    together, one token each per step, and new sequences join (after their
+    own prefill) and finished ones leave between steps.
+
+    The rows of the shared kv cache are left-padded to a common number of
+    slots; pad holds each row's first real slot, its positions count from
+    there and the padding is masked out. When the slots run out, the padding
+    all rows have in common is dropped.
+
+    The model work of a step runs on executor (if given), the sampled tokens
+    are delivered to the consumers back on the event loop. A sequence whose
+    prefill fails is failed alone; a failed step fails all running sequences
+    and starts over with an empty batch.
+    """
+
+    def __init__(self, model: GPT, max_batch_size: int = 32, executor: Optional[DeviceExecutor] = None, stream=None):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.executor = executor
+        self.stream = stream
+        self.device = next(model.parameters()).device
+        self.waiting: list[Sequence] = []
+        self.running: list[Sequence] = []
+        self.kv_cache: Optional[KVCache] = None
+        self.pad: Optional[torch.Tensor] = None # (b,) first real slot of each row
+        self.next_tokens: Optional[torch.Tensor] = None # (b, 1) the input of the next step
+        self.temperature: Optional[torch.Tensor] = None # (b,)
+        self.top_k: Optional[torch.Tensor] = None # (b,)
+        self.wake = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.stats = GenerationStats()
+
+    def accepts(self, tokens: list[int], max_new_tokens: int) -> bool:
+        # longer generations need the sliding window of GPT.generate_generator
+        return 0 < len(tokens) and len(tokens) + max_new_tokens <= self.model.config.block_size
+
+    async def generate(self, tokens: list[int], max_new_tokens: int, temperature: float, top_k: int) -> AsyncIterator[list[int]]:
+        """Yields the sampled tokens in chunks of whatever was generated since the last one"""
+        assert self.accepts(tokens, max_new_tokens)
+        if max_new_tokens <= 0:
+            return
+        sequence = Sequence(tokens, max_new_tokens, temperature, min(top_k, self.model.config.vocab_size))
+        self.waiting.append(sequence)
+        self.stats.sequences += 1
+        self.wake.set()
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        try:
+            while True:
+                await sequence.ready.wait()
+                sequence.ready.clear()
+                chunk, sequence.pending = sequence.pending, []
+                if chunk:
+                    yield chunk
+                if sequence.error is not None:
+                    raise sequence.error
+                if sequence.finished and not sequence.pending:
+                    return
+        finally:
+            sequence.cancelled = True
+
+    async def run(self):
+        while True:
+            if not self.running and not self.waiting:
+                self.wake.clear()
+                await self.wake.wait()
+            free = self.max_batch_size - len(self.running)
+            admitting, self.waiting = self.waiting[:free], self.waiting[free:]
+            try:
+                if self.executor is not None:
+                    emitted, failed = await self.executor.run(self.iterate, admitting, bounded=False)
+                else:
+                    emitted, failed = self.iterate(admitting)
+            except Exception as e:
+                # the batch state can't be trusted after a failed step
+                failed = [(sequence, e) for sequence in self.running + admitting]
+                emitted = []
+                self.reset()
+            for sequence, token in emitted:
+                sequence.deliver(token)
+            for sequence, error in failed:
+                sequence.fail(error)
+            # let the handlers send what was generated
+            await asyncio.sleep(0)
+
+    def reset(self):
+        self.running = []
+        self.kv_cache = self.pad = self.next_tokens = self.temperature = self.top_k = None
+
+    def iterate(self, admitting: list[Sequence]) -> tuple[list[tuple[Sequence, int]], list[tuple[Sequence, Exception]]]:
+        emitted = []
+        failed = []
+        with torch.no_grad(), self.model.config.ctx or nullcontext(), torch.cuda.stream(self.stream):
+            self.admit(admitting, emitted, failed)
+            self.retire()
+            if self.running:
+                self.step(emitted)
+                self.retire()
+        return emitted, failed
+
+    def admit(self, admitting: list[Sequence], emitted: list[tuple[Sequence, int]], failed: list[tuple[Sequence, Exception]]):
+        for sequence in admitting:
+            if sequence.cancelled:
+                continue
+            kv_cache = KVCache(self.model.config)
+            temperature = torch.tensor([sequence.temperature], device=self.device)
+            top_k = torch.tensor([sequence.top_k], dtype=torch.long, device=self.device)
+            try:
+                idx = torch.tensor([sequence.tokens], dtype=torch.long, device=self.device)
+                logits, _ = self.model(idx, kv_cache=kv_cache)
+                idx_next = self.model.sample_logits_rows(logits[:, -1, :], temperature, top_k)
+                token = int(idx_next)
+            except Exception as e:
+                # nothing of the batch has been touched yet
+                failed.append((sequence, e))
+                continue
+            sequence.sample(token, emitted)
+            self.stats.tokens += 1
+            if sequence.done:
+                continue
+
+            if self.kv_cache is None:
+                self.kv_cache = kv_cache
+                self.pad = torch.zeros(1, dtype=torch.long, device=self.device)
+                self.next_tokens, self.temperature, self.top_k = idx_next, temperature, top_k
+            else:
+                # bring both caches to the same number of slots
+                slots = self.kv_cache.length
+                if kv_cache.length < slots:
+                    pad = slots - kv_cache.length
+                    kv_cache.pad_left(pad)
+                else:
+                    pad = 0
+                    self.kv_cache.pad_left(kv_cache.length - slots)
+                    self.pad += kv_cache.length - slots
+                self.kv_cache.merge(kv_cache)
+                self.pad = torch.cat((self.pad, torch.tensor([pad], device=self.device)))
+                self.next_tokens = torch.cat((self.next_tokens, idx_next))
+                self.temperature = torch.cat((self.temperature, temperature))
+                self.top_k = torch.cat((self.top_k, top_k))
+            self.running.append(sequence)
+        self.stats.max_batch_size = max(self.stats.max_batch_size, len(self.running))
+
+    def retire(self):
+        keep = [i for i, sequence in enumerate(self.running) if not (sequence.done or sequence.cancelled)]
+        if len(keep) == len(self.running):
+            return
+        if not keep:
+            self.reset()
+            return
+        self.running = [self.running[i] for i in keep]
+        rows = torch.tensor(keep, dtype=torch.long, device=self.device)
+        self.kv_cache.select(rows)
+        self.pad = self.pad[rows]
+        self.next_tokens = self.next_tokens[rows]
+        self.temperature = self.temperature[rows]
+        self.top_k = self.top_k[rows]
+
+    def step(self, emitted: list[tuple[Sequence, int]]):
+        slots = self.kv_cache.length
+        if slots == self.kv_cache.max_length:
+            # accepts() guarantees every row has padding left to drop
+            shift = int(self.pad.min())
+            self.kv_cache.drop_left(shift)
+            self.pad -= shift
+            slots -= shift
+        key_valid = torch.arange(slots + 1, device=self.device) >= self.pad[:, None]
+        logits, _ = self.model(
+            self.next_tokens,
+            kv_cache=self.kv_cache,
+            pos=slots - self.pad[:, None],
+            attn_mask=key_valid[:, None, None, :],
+        )
+        self.next_tokens = self.model.sample_logits_rows(logits[:, -1, :], self.temperature, self.top_k)
+        # a single copy to the host per step for all sequences
+        for sequence, token in zip(self.running, self.next_tokens[:, 0].tolist()):
+            sequence.sample(token, emitted)
+        self.stats.steps += 1
+        self.stats.rows += len(self.running)
+        self.stats.tokens += len(self.running)
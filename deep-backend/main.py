@@ -1,13 +1,17 @@
 from dataclasses import dataclass
+from typing import AsyncIterator, Optional, Union
+from contextlib import nullcontext
+from functools import partial
+import gzip
 import heapq
 import datetime
-from math import inf
 import math
 from collections import defaultdict
 import numpy as np
 from torch.nn import functional as F
 import re
-from fastapi import FastAPI, HTTPException, WebSocket
+from fastapi import FastAPI, HTTPException, Request, WebSocket
+from fastapi.responses import JSONResponse, Response
 from fastapi.encoders import jsonable_encoder
 import asyncio
 from models import (
@@ -15,17 +19,29 @@ from models import (
     BirthyearResponse,
     InferenceRequest,
     LogitsResponse,
+    LogitsTopKResponse,
     RequestUnion,
     InferenceResponse,
     LogitsRequest,
     BirthyearStats,
+    CompareRequest,
+    CompareModelResult,
+    CompareResponse,
     ForcingTokenStep,
     ForcingAlternativeToken,
     ForcingRequest,
-    ForcingResponse
+    ForcingResponse,
+    PrefixCacheStats,
+    BatchingStats,
+    GenerationEngineStats,
+    InferenceConfig,
+    DeviceExecutorStats,
 )
-from vocabulary import Vocabulary
-from gpt import GPT
+from vocabulary import IncrementalDecoder, Vocabulary
+from gpt import GPT, PrefixCache, ScoreResult, StackedGPT
+from batching import BatchScheduler
+from execution import DeviceExecutor, QueueFull
+from generation import GenerationEngine
 import os
 import torch
 
@@ -35,96 +51,273 @@ class ModelLocation:
     name: str
     ckpt: int
     cuda_gpu: int
+    vocab: str = "fineweb2.vocab"
+    # finetunes are loaded from delta_{ckpt}.pt against this model if that exists
+    base: Optional[str] = None
+    # one of gpt.PRECISIONS, the int8 ones are served on the cpu
+    precision: str = "bf16"
+
+    @property
+    def device(self) -> str:
+        return "cpu" if self.precision.startswith("int8") else f"cuda:{self.cuda_gpu}"
 
 
 MODEL_LOCATIONS = [
-    ModelLocation("anticausal1", 300_000, 9),
-    ModelLocation("causal1", 300_000, 9),
+    ModelLocation("anticausal1", 300_000, 9, vocab="german-complete.vocab"),
+    ModelLocation("causal1", 300_000, 9, vocab="german-complete.vocab"),
     ModelLocation("anticausal-fw2", 300_000, 9),
     ModelLocation("causal-fw2", 300_000, 9),
-    ModelLocation("anticausal-fw2-laws1", 301_000, 9),
-    ModelLocation("causal-fw2-laws1", 301_000, 9),
-    ModelLocation("anticausal-fw2-wikipedia1", 400_000, 9),
-    ModelLocation("causal-fw2-wikipedia1", 400_000, 9),
-    ModelLocation("anticausal-fw2-gutenberg1", 350_000, 9),
-    ModelLocation("causal-fw2-gutenberg1", 350_000, 9),
-    ModelLocation("anticausal-fw2-plenar1", 305_000, 9),
-    ModelLocation("causal-fw2-plenar1", 305_000, 9),
+    ModelLocation("anticausal-fw2-laws1", 301_000, 9, base="anticausal-fw2"),
+    ModelLocation("causal-fw2-laws1", 301_000, 9, base="causal-fw2"),
+    ModelLocation("anticausal-fw2-wikipedia1", 400_000, 9, base="anticausal-fw2"),
+    ModelLocation("causal-fw2-wikipedia1", 400_000, 9, base="causal-fw2"),
+    ModelLocation("anticausal-fw2-gutenberg1", 350_000, 9, base="anticausal-fw2"),
+    ModelLocation("causal-fw2-gutenberg1", 350_000, 9, base="causal-fw2"),
+    ModelLocation("anticausal-fw2-plenar1", 305_000, 9, base="anticausal-fw2"),
+    ModelLocation("causal-fw2-plenar1", 305_000, 9, base="causal-fw2"),
 ]
 
 # Load models and assign a unique CUDA Stream to each
 MODELS = {}
 STREAMS = {}
+MODEL_VOCABS = {model.name: model.vocab for model in MODEL_LOCATIONS}
+MODEL_PRECISIONS = {model.name: model.precision for model in MODEL_LOCATIONS}
+VOCABS: dict[str, Vocabulary] = {}
 
-for model in MODEL_LOCATIONS:
-    device = f"cuda:{model.cuda_gpu}"
-    MODELS[model.name] = GPT.load(
-        os.path.join("/output", model.name, f"ckpt_{model.ckpt}.pt"),
-        device=device,
-        compile=False,
-    )
-    MODELS[model.name].eval()
-    STREAMS[model.name] = torch.cuda.Stream(device=torch.device(device))
 
-app = FastAPI()
+ENCODE_CACHE_SIZE = 4096
+# generations past block_size refill the kv cache every this many tokens
+GENERATION_WINDOW_STRIDE = 256
+# sampled tokens are copied from the device once every this many tokens
+GENERATION_CHUNK_SIZE = 8
+# keys and values of shared prompt prefixes, per model
+PREFIX_CACHES: dict[str, PrefixCache] = {}
+PREFIX_CACHE_BYTES = 512 * 1024 * 1024
 
 
-@app.get("/")
-async def root():
-    return {"message": "Hello, world!"}
+def get_vocab(filename: str) -> Vocabulary:
+    if filename not in VOCABS:
+        VOCABS[filename] = Vocabulary.load(filename)
+        VOCABS[filename].set_encode_cache(ENCODE_CACHE_SIZE)
+    return VOCABS[filename]
 
 
-async def async_infer(model_name: str, input_tensor, return_all_logits=False):
-    """Runs inference asynchronously using CUDA streams"""
-    model = MODELS[model_name]
-    stream = STREAMS[model_name]
-    device = next(model.parameters()).device
+def get_prefix_cache(model_id: str) -> PrefixCache:
+    if model_id not in PREFIX_CACHES:
+        PREFIX_CACHES[model_id] = PrefixCache(MODELS[model_id], max_bytes=PREFIX_CACHE_BYTES)
+    return PREFIX_CACHES[model_id]
 
-    input_tensor = input_tensor.to(device)
+DELTA_MODELS = set()
 
-    with torch.no_grad():
-        with torch.cuda.stream(stream):
-            logits, _ = model.forward(input_tensor, return_all_logits=return_all_logits)
+for model in MODEL_LOCATIONS:
+    device = model.device
+    delta_path = os.path.join("/output", model.name, f"delta_{model.ckpt}.pt")
+    # deltas share the weights of their base, so they need the same (unquantized) precision
+    if (
+        model.base is not None
+        and model.precision in ("fp32", "bf16")
+        and MODEL_PRECISIONS[model.base] == model.precision
+        and os.path.exists(delta_path)
+    ):
+        MODELS[model.name] = GPT.load_delta(delta_path, MODELS[model.base])
+        DELTA_MODELS.add(model.name)
+    else:
+        MODELS[model.name] = GPT.load(
+            os.path.join("/output", model.name, f"ckpt_{model.ckpt}.pt"),
+            device=device,
+            compile=False,
+            precision=model.precision,
+        )
+    MODELS[model.name].eval()
+    # torch.cuda.stream(None) is a no-op, for models on the cpu
+    STREAMS[model.name] = torch.cuda.Stream(device=torch.device(device)) if device.startswith("cuda") else None
 
-    stream.synchronize()
+# blocking model work runs on one worker thread per device
+EXECUTORS = {device: DeviceExecutor(device) for device in {model.device for model in MODEL_LOCATIONS}}
+MODEL_EXECUTORS = {model.name: EXECUTORS[model.device] for model in MODEL_LOCATIONS}
 
-    return logits.detach().cpu().numpy().tolist()
+# models with the same config, vocabulary and device are also run as one stack,
+# except for delta finetunes, which already share their weights with the base
+STACKS: list[tuple[list[str], StackedGPT]] = []
+stack_groups = defaultdict(list)
+for model in MODEL_LOCATIONS:
+    if model.name in DELTA_MODELS:
+        continue
+    if model.precision not in ("fp32", "bf16"):
+        continue
+    stack_groups[(model.vocab, model.device, model.precision, repr(MODELS[model.name].config))].append(model.name)
+for names in stack_groups.values():
+    if len(names) > 1:
+        STACKS.append((names, StackedGPT(
+            [MODELS[name] for name in names],
+            reverse=[name.startswith("anticausal") for name in names],
+        )))
 
-def analyze_logits_for_target(
-    logits_vector: torch.Tensor, target_token_id: int
-) -> ForcingTokenStep:
-    log_probs = F.log_softmax(logits_vector, dim=-1)
+app = FastAPI()
 
-    target_log_prob = log_probs[target_token_id].item()
 
-    sorted_indices = torch.argsort(log_probs, descending=True)
-    rank = (sorted_indices == target_token_id).nonzero(as_tuple=True)[0].item()
+@app.exception_handler(QueueFull)
+async def queue_full_handler(request: Request, exc: QueueFull):
+    return JSONResponse(status_code=503, content={"detail": str(exc)})
 
-    top_log_probs, top_token_ids = torch.topk(log_probs, 100)
 
-    alternatives = [
-        ForcingAlternativeToken(token_id=token_id.item(), logit=log_prob.item())
-        for token_id, log_prob in zip(top_token_ids, top_log_probs)
-    ]
+@app.get("/")
+async def root():
+    return {"message": "Hello, world!"}
 
-    return ForcingTokenStep(
-        logit=target_log_prob,
-        k=rank,
-        alternatives=alternatives
-    )
 
-@app.post("/model/{model_id}/logits")
-async def model_logits(model_id: str, request: LogitsRequest) -> LogitsResponse:
+@dataclass
+class ForwardRequest:
+    tokens: list[int]
+    # score these targets (one per token) instead of returning the last logits
+    targets: Optional[list[int]] = None
+    # alternatives to keep per scored position
+    top_k: int = 0
+
+
+def forward_batch(model_id: str, requests: list[ForwardRequest]) -> list[Union[torch.Tensor, ScoreResult]]:
+    """
+    Runs a batch of ForwardRequests as one right-padded forward, returns per
+    request the cpu logits of its last position or, if it has targets, its
+    cpu ScoreResult
+    """
+    model = MODELS[model_id]
+    stream = STREAMS[model_id]
+    device = next(model.parameters()).device
+
+    lengths = [len(request.tokens) for request in requests]
+    idx = torch.zeros(len(requests), max(lengths), dtype=torch.long)
+    targets = torch.full_like(idx, -1)
+    for i, request in enumerate(requests):
+        idx[i, :lengths[i]] = torch.tensor(request.tokens, dtype=torch.long)
+        if request.targets is not None:
+            targets[i, :lengths[i]] = torch.tensor(request.targets, dtype=torch.long)
+    scored = [i for i, request in enumerate(requests) if request.targets is not None]
+    top_k = max((requests[i].top_k for i in scored), default=0)
+
+    with torch.no_grad(), model.config.ctx or nullcontext():
+        with torch.cuda.stream(stream):
+            # attention is causal, so the padding behind each row never reaches its real positions
+            x = model.hidden_states(idx.to(device))
+            rows = torch.arange(len(requests), device=device)
+            last = torch.tensor(lengths, device=device) - 1
+            last_logits = model.lm_head(x[rows, last]).float()
+            if scored:
+                # the padding is skipped with a target of -1
+                rows = torch.tensor(scored, device=device)
+                score = model.score_hidden_states(x[rows], targets[scored].to(device), top_k=top_k)
+
+    if stream is not None:
+        stream.synchronize()
+
+    # only the compact results are copied to the host
+    last_logits = last_logits.cpu()
+    if scored:
+        score = ScoreResult(
+            log_probs=score.log_probs.cpu(),
+            ranks=score.ranks.cpu(),
+            top_ids=score.top_ids.cpu(),
+            top_log_probs=score.top_log_probs.cpu(),
+        )
+    results: list[Union[torch.Tensor, ScoreResult]] = [last_logits[i] for i in range(len(requests))]
+    for row, i in enumerate(scored):
+        results[i] = ScoreResult(
+            log_probs=score.log_probs[row, :lengths[i]],
+            ranks=score.ranks[row, :lengths[i]],
+            top_ids=score.top_ids[row, :lengths[i], :requests[i].top_k],
+            top_log_probs=score.top_log_probs[row, :lengths[i], :requests[i].top_k],
+        )
+    return results
+
+
+# concurrent websocket generations of a model are decoded as one batch
+GENERATION_BATCH_SIZE = 32
+ENGINES = {
+    model_id: GenerationEngine(
+        model,
+        max_batch_size=GENERATION_BATCH_SIZE,
+        executor=MODEL_EXECUTORS[model_id],
+        stream=STREAMS[model_id],
+    )
+    for model_id, model in MODELS.items()
+}
+
+
+# requests arriving within BATCH_WINDOW seconds of each other share one forward
+BATCH_WINDOW = 0.005
+MAX_BATCH_SIZE = 16
+MAX_BATCH_TOKENS = 8192
+SCHEDULERS = {
+    model_id: BatchScheduler(
+        partial(forward_batch, model_id),
+        max_wait=BATCH_WINDOW,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_batch_tokens=MAX_BATCH_TOKENS,
+        executor=MODEL_EXECUTORS[model_id],
+    )
+    for model_id in MODELS
+}
+
+
+def validate_tokens(model_id: str, tokens: list[int]):
+    if not tokens:
+        raise HTTPException(400, "at least one token required")
+    if len(tokens) > MODELS[model_id].config.block_size:
+        raise HTTPException(400, f"at most {MODELS[model_id].config.block_size} tokens allowed")
+    # a bad id would fail the whole batch it ends up in
+    vocab_size = MODELS[model_id].config.vocab_size
+    if not all(0 <= token < vocab_size for token in tokens):
+        raise HTTPException(400, f"token ids must be in [0, {vocab_size})")
+
+async def infer(model_id: str, tokens: list[int], targets: Optional[list[int]] = None, top_k: int = 0) -> Union[torch.Tensor, ScoreResult]:
+    validate_tokens(model_id, tokens)
+    if targets is not None:
+        validate_tokens(model_id, targets)
+    return await SCHEDULERS[model_id].submit(ForwardRequest(tokens, targets, top_k), len(tokens))
+
+# alternatives listed for each position of a forcing analysis
+FORCING_TOP_K = 100
+
+# binary logits, as little-endian arrays of one value per vocabulary entry
+LOGITS_MEDIA_TYPES = {
+    "application/x-float32": "<f4",
+    "application/x-float16": "<f2",
+}
+
+def logits_media_type(accept: str) -> Optional[str]:
+    """The first binary logits encoding listed in an Accept header, if any"""
+    for media_type in accept.split(","):
+        media_type = media_type.split(";")[0].strip()
+        if media_type in LOGITS_MEDIA_TYPES:
+            return media_type
+    return None
+
+def encode_logits(logits: torch.Tensor, media_type: str, compress: bool) -> bytes:
+    content = logits.numpy().astype(LOGITS_MEDIA_TYPES[media_type]).tobytes()
+    return gzip.compress(content, compresslevel=1) if compress else content
+
+@app.post("/model/{model_id}/logits", response_model=Union[LogitsResponse, LogitsTopKResponse])
+async def model_logits(model_id: str, request: LogitsRequest, http_request: Request):
     if model_id not in MODELS:
         raise HTTPException(404, "Model not found")
 
-    # Prepare input tensor
-    idx = torch.tensor([request.token_input], dtype=torch.long)
+    logits = await infer(model_id, request.token_input)
+
+    if request.top_k is not None:
+        log_probs, token_ids = torch.topk(F.log_softmax(logits, dim=-1), min(request.top_k, logits.size(-1)))
+        return LogitsTopKResponse(token_ids=token_ids.tolist(), log_probs=log_probs.tolist())
 
-    # Run inference asynchronously
-    logits = await async_infer(model_id, idx)
+    media_type = logits_media_type(http_request.headers.get("accept", ""))
+    if media_type is not None:
+        compress = "gzip" in http_request.headers.get("accept-encoding", "")
+        content = await asyncio.to_thread(encode_logits, logits, media_type, compress)
+        return Response(
+            content=content,
+            media_type=media_type,
+            headers={"Content-Encoding": "gzip"} if compress else None,
+        )
 
-    return LogitsResponse(logits=logits[0][0])  # Adjust indexing based on model output
+    return LogitsResponse(logits=logits.tolist())
 
 @app.post("/model/{model_id}/forcing")
 async def forcing(model_id: str, request: ForcingRequest) -> ForcingResponse:
@@ -134,47 +327,168 @@ async def forcing(model_id: str, request: ForcingRequest) -> ForcingResponse:
     if len(request.token_input) < 2:
         raise HTTPException(status_code=400, detail="at least two tokens required")
 
-    context_tensor = torch.tensor([request.token_input[:-1]], dtype=torch.long)
-
-    logits_np = await async_infer(model_id, context_tensor, return_all_logits=True)
-    logits = torch.from_numpy(np.array(logits_np)).squeeze(0)
-
-    if logits.dim() == 1:
-        logits = logits.unsqueeze(0)
-
-    total_logprob = 0.0
-    step_results = []
-
-    for i in range(logits.shape[0]):
-        target_token_id = request.token_input[i + 1]
-        step_result = analyze_logits_for_target(logits[i], target_token_id)
-
-        step_results.append(step_result)
-        total_logprob += step_result.logit
+    score = await infer(
+        model_id,
+        request.token_input[:-1],
+        targets=request.token_input[1:],
+        top_k=min(FORCING_TOP_K, MODELS[model_id].config.vocab_size),
+    )
 
+    return await asyncio.to_thread(forcing_response, score)
+
+def forcing_response(score: ScoreResult) -> ForcingResponse:
+    log_probs = score.log_probs.tolist()
+    steps = [
+        ForcingTokenStep(
+            logit=log_prob,
+            k=rank,
+            alternatives=[
+                ForcingAlternativeToken(token_id=token_id, logit=alternative_log_prob)
+                for token_id, alternative_log_prob in zip(top_ids, top_log_probs)
+            ],
+        )
+        for log_prob, rank, top_ids, top_log_probs in zip(
+            log_probs,
+            score.ranks.tolist(),
+            score.top_ids.tolist(),
+            score.top_log_probs.tolist(),
+        )
+    ]
     return ForcingResponse(
-        total_logprob=total_logprob,
-        steps=step_results
+        total_logprob=sum(log_probs),
+        steps=steps
+    )
+
+@app.post("/compare")
+async def compare(request: CompareRequest) -> CompareResponse:
+    for model_id in request.model_ids:
+        if model_id not in MODELS:
+            raise HTTPException(404, "Model not found")
+    stack = next(
+        ((names, stack) for names, stack in STACKS if set(request.model_ids) <= set(names)),
+        None,
+    )
+    if stack is None:
+        raise HTTPException(400, "models can't be compared in one pass")
+    names, stack = stack
+    validate_tokens(names[0], request.token_input)
+    top_k = min(request.top_k, MODELS[names[0]].config.vocab_size)
+
+    top_log_probs, top_ids, total_logprobs = await MODEL_EXECUTORS[names[0]].run(
+        compare_stack, names, stack, request.token_input, top_k
     )
 
+    return CompareResponse(results={
+        name: CompareModelResult(
+            total_logprob=total_logprobs[i],
+            alternatives=[
+                ForcingAlternativeToken(token_id=token_id, logit=log_prob)
+                for token_id, log_prob in zip(top_ids[i], top_log_probs[i])
+            ],
+        )
+        for i, name in enumerate(names)
+        if name in request.model_ids
+    })
+
+def compare_stack(names: list[str], stack: StackedGPT, tokens: list[int], top_k: int):
+    device = stack.reverse.device
+    idx = torch.tensor([tokens], dtype=torch.long, device=device)
+    with torch.no_grad(), torch.cuda.stream(STREAMS[names[0]]), MODELS[names[0]].config.ctx or nullcontext():
+        log_probs = F.log_softmax(stack(idx)[:, 0, -1].float(), dim=-1)
+        top_log_probs, top_ids = torch.topk(log_probs, top_k, dim=-1)
+        if idx.size(1) > 1:
+            total_logprobs = stack.score(idx)[:, 0].sum(dim=-1)
+        else:
+            total_logprobs = torch.zeros(stack.n, device=device)
+        return top_log_probs.tolist(), top_ids.tolist(), total_logprobs.tolist()
+
+@app.get("/executors")
+async def executor_stats() -> dict[str, DeviceExecutorStats]:
+    return {
+        device: DeviceExecutorStats(
+            pending=executor.stats.pending,
+            completed=executor.stats.completed,
+            rejected=executor.stats.rejected,
+        )
+        for device, executor in EXECUTORS.items()
+    }
+
+@app.get("/batching")
+async def batching_stats() -> dict[str, BatchingStats]:
+    return {
+        model_id: BatchingStats(
+            queue_depth=scheduler.queue_depth,
+            requests=scheduler.stats.requests,
+            batches=scheduler.stats.batches,
+            mean_batch_size=scheduler.stats.mean_batch_size,
+            max_batch_size=scheduler.stats.max_batch_size,
+            last_batch_size=scheduler.stats.last_batch_size,
+            batch_sizes=scheduler.stats.batch_sizes,
+        )
+        for model_id, scheduler in SCHEDULERS.items()
+    }
+
+@app.get("/generation")
+async def generation_stats() -> dict[str, GenerationEngineStats]:
+    return {
+        model_id: GenerationEngineStats(
+            running=len(engine.running),
+            waiting=len(engine.waiting),
+            sequences=engine.stats.sequences,
+            steps=engine.stats.steps,
+            tokens=engine.stats.tokens,
+            mean_batch_size=engine.stats.mean_batch_size,
+            max_batch_size=engine.stats.max_batch_size,
+        )
+        for model_id, engine in ENGINES.items()
+    }
+
+@app.get("/prefix-cache")
+async def prefix_cache_stats() -> dict[str, PrefixCacheStats]:
+    stats = {}
+    for model_id, prefix_cache in PREFIX_CACHES.items():
+        info = prefix_cache.info()
+        stats[model_id] = PrefixCacheStats(
+            hit_rate=info.hit_rate,
+            hit_tokens=info.hit_tokens,
+            miss_tokens=info.miss_tokens,
+            bytes=info.bytes,
+            max_bytes=info.max_bytes,
+            entries=info.entries,
+        )
+    return stats
+
+def birthyear_step(model_id: str, prefix_cache: PrefixCache, tokens: list[int], token_mask, is_masked):
+    """Returns the masked-out probability mass and the top 100 allowed continuations with their log-probs"""
+    device = next(MODELS[model_id].parameters()).device
+    with torch.no_grad(), torch.cuda.stream(STREAMS[model_id]):
+        model_y = prefix_cache.forward(torch.tensor([tokens], device=device)).float()
+        next_token_probs = F.softmax(model_y[0][0], dim=-1)
+        discarded_mass_step = torch.sum(next_token_probs.masked_fill(~is_masked, 0.0))
+        probs = F.log_softmax(model_y[0][0] + token_mask, dim=-1)
+        top_probs, top_tokens = torch.topk(probs, 100)
+        return discarded_mass_step.item(), top_probs.tolist(), top_tokens.tolist()
+
 @app.post("/birthyear")
 async def birthyear(request: BirthyearRequest) -> BirthyearResponse:
     INCLUDE_EXPR = re.compile(r"^[0-9]+ ?")
     COMPLETE_YEAR = re.compile(r"^[0-9]{4}")
     NECESSARY_EXPR = re.compile(r"^[0-9]{0,3}$")
 
-    vocab = Vocabulary.load("fineweb2.vocab")
     model_id = "causal-fw2-wikipedia1"
     if model_id not in MODELS:
         raise HTTPException(404, "Model not found")
     model = MODELS[model_id]
     device = next(model.parameters()).device
+    vocab = get_vocab(MODEL_VOCABS[model_id])
+    prefix_cache = get_prefix_cache(model_id)
 
-    token_mask = torch.zeros(50304, device=device)
-    for token in range(50256):
-        string = vocab.decode([token])
-        if not re.match(INCLUDE_EXPR, string):
-            token_mask[token] = -float("inf")
+    vocab_size = model.config.vocab_size
+    token_mask = vocab.token_mask(INCLUDE_EXPR, size=vocab_size, device=device)
+    is_masked = ~vocab.token_mask(INCLUDE_EXPR, size=vocab_size, device=device, additive=False)
+
+    prompt = f"# {request.first_name} {request.last_name}\n\n{request.first_name} {request.last_name} (* {request.day} "
+    prompt_ids = vocab.encode(prompt)
 
     continuations = [(-0.0, ())]
 
@@ -189,28 +503,27 @@ async def birthyear(request: BirthyearRequest) -> BirthyearResponse:
         if log_prob < math.log(1e-4):
             continue
         string = vocab.decode(list(tokens))
-        input_string = f"# {request.first_name} {request.last_name}\n\n{request.first_name} {request.last_name} (* {request.day} {string}"
         if re.match(COMPLETE_YEAR, string):
             year = int(string[:4])
             results[year] += math.exp(log_prob)
         if not re.match(NECESSARY_EXPR, string):
             continue
 
-        model_x = torch.tensor([vocab.encode(input_string)], device=device)
-        model_y, _ = model(model_x)
+        discarded_mass_step, top_probs, top_tokens = await MODEL_EXECUTORS[model_id].run(
+            birthyear_step,
+            model_id,
+            prefix_cache,
+            vocab.encode_incremental(prompt, prompt_ids, string),
+            token_mask,
+            is_masked,
+        )
 
         # Berechnung der Konfidenz ohne Tokenmaske
-        with torch.no_grad():
-            current_path_prob = math.exp(log_prob)
-            next_token_probs = F.softmax(model_y[0][0], dim=-1)
-            is_masked = token_mask == -inf
-            discarded_mass_step = torch.sum(next_token_probs[is_masked]).item()
-            total_discarded_prob_mass += current_path_prob * discarded_mass_step
+        current_path_prob = math.exp(log_prob)
+        total_discarded_prob_mass += current_path_prob * discarded_mass_step
 
-        probs = F.log_softmax(model_y[0][0] + token_mask, dim=-1)
-        top_probs, top_tokens = torch.topk(probs, 100)
         for token, token_log_prob in zip(top_tokens, top_probs):
-            heapq.heappush(continuations, (-(log_prob + token_log_prob.item()), tokens + (int(token.item()),)))
+            heapq.heappush(continuations, (-(log_prob + token_log_prob), tokens + (token,)))
 
     prob_sum = sum(results.values())
     results = {year: prob / prob_sum for year, prob in results.items()}
@@ -248,6 +561,35 @@ async def birthyear(request: BirthyearRequest) -> BirthyearResponse:
         discarded_prob_ratio=discarded_prob_ratio
     )
 
+async def generation_chunks(model_id: str, tokens: list[int], config: InferenceConfig) -> AsyncIterator[list[int]]:
+    vocab_size = MODELS[model_id].config.vocab_size
+    if not all(0 <= token < vocab_size for token in tokens):
+        raise HTTPException(400, f"token ids must be in [0, {vocab_size})")
+    engine = ENGINES[model_id]
+    if engine.accepts(tokens, config.num_tokens):
+        async for chunk in engine.generate(tokens, config.num_tokens, config.temperature, config.top_k):
+            yield chunk
+        return
+
+    # generations past block_size run on their own with a sliding window
+    model = MODELS[model_id]
+    input_tensor = torch.tensor([tokens]).to(next(model.parameters()).device)
+    chunks = model.generate_chunks(
+        input_tensor,
+        max_new_tokens=config.num_tokens,
+        temperature=config.temperature,
+        top_k=config.top_k,
+        chunk_size=GENERATION_CHUNK_SIZE,
+        window_stride=GENERATION_WINDOW_STRIDE,
+    )
+
+    def next_chunk():
+        with torch.cuda.stream(STREAMS[model_id]):
+            return next(chunks, None)
+
+    while (chunk := await MODEL_EXECUTORS[model_id].run(next_chunk)) is not None:
+        yield chunk[0]
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
@@ -260,44 +602,49 @@ async def websocket_endpoint(websocket: WebSocket):
                 if request.action.model_id not in MODELS:
                     raise HTTPException(404, "Model not found")
 
-                model = MODELS[request.action.model_id]
-                stream = STREAMS[request.action.model_id]
-                device = next(model.parameters()).device
-
-                input_tensor = torch.tensor([request.action.token_input]).to(device)
+                decoder = None
+                if request.action.config.stream_text:
+                    decoder = IncrementalDecoder(
+                        get_vocab(MODEL_VOCABS[request.action.model_id]),
+                        reverse=request.action.model_id.startswith("anticausal"),
+                    )
 
-                with torch.no_grad(), torch.cuda.stream(stream):
-                    rest_tokens = []
-                    last_send = datetime.datetime.now()
-                    for token in model.generate_generator(
-                        input_tensor,
-                        max_new_tokens=request.action.config.num_tokens,
-                        temperature=request.action.config.temperature,
-                        top_k=request.action.config.top_k,
+                rest_tokens = []
+                rest_text = ""
+                last_send = datetime.datetime.now()
+                async for chunk in generation_chunks(request.action.model_id, request.action.token_input, request.action.config):
+                    rest_tokens.extend(chunk)
+                    if decoder is not None:
+                        new_text = decoder.push(chunk)
+                        rest_text = new_text + rest_text if decoder.reverse else rest_text + new_text
+                    await asyncio.sleep(request.action.config.synthetic_wait * len(chunk))
+                    if datetime.datetime.now() - last_send >= datetime.timedelta(
+                        seconds=0.1
                     ):
-                        rest_tokens.append(token)
-                        await asyncio.sleep(request.action.config.synthetic_wait)
-                        if datetime.datetime.now() - last_send >= datetime.timedelta(
-                            seconds=0.1
-                        ):
-                            await websocket.send_json(
-                                jsonable_encoder(
-                                    InferenceResponse(
-                                        type=request.action.type,
-                                        request_id=request.request_id,
-                                        tokens=rest_tokens,
-                                        done=False,
-                                    )
+                        await websocket.send_json(
+                            jsonable_encoder(
+                                InferenceResponse(
+                                    type=request.action.type,
+                                    request_id=request.request_id,
+                                    tokens=rest_tokens,
+                                    text=rest_text if decoder is not None else None,
+                                    done=False,
                                 )
                             )
-                            last_send = datetime.datetime.now()
-                            rest_tokens = []
+                        )
+                        last_send = datetime.datetime.now()
+                        rest_tokens = []
+                        rest_text = ""
+                if decoder is not None:
+                    final_text = decoder.finish()
+                    rest_text = final_text + rest_text if decoder.reverse else rest_text + final_text
                 await websocket.send_json(
                     jsonable_encoder(
                         InferenceResponse(
                             type=request.action.type,
                             request_id=request.request_id,
                             tokens=rest_tokens,
+                            text=rest_text if decoder is not None else None,
                             done=True,
                         )
                     )
@@ -0,0 +1,69 @@
+"""
+Compares the logits of a model in every inference precision (see
+GPT.set_precision) against float32 on the same inputs and reports the
+divergence and the latency, to decide where a model can be served.
+$ python check_precision.py --ckpt=/output/causal-fw2/ckpt_300000.pt --text_file=some.txt
+"""
+import time
+import torch
+from torch.nn import functional as F
+from contextlib import nullcontext
+from gpt import GPT, PRECISIONS
+from vocabulary import Vocabulary
+
+# -----------------------------------------------------------------------------
+ckpt = "/output/causal-fw2/ckpt_300000.pt"
+precisions = ",".join(PRECISIONS) # comma separated
+device = "cuda" # device of the fp32 reference and the bf16 mode; int8 modes always run on cpu
+vocab_file = "fineweb2.vocab"
+text_file = "" # lines of this file are the inputs, random tokens otherwise
+num_inputs = 8
+input_length = 256
+seed = 1337
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+torch.manual_seed(seed)
+
+def run(model, device):
+    all_logits = []
+    elapsed = 0.0
+    with torch.no_grad(), model.config.ctx or nullcontext():
+        for tokens in inputs:
+            idx = torch.tensor([tokens], device=device)
+            start = time.perf_counter()
+            logits, _ = model(idx, return_all_logits=True)
+            logits = logits.float().cpu()
+            elapsed += time.perf_counter() - start
+            all_logits.append(logits[0])
+    return torch.cat(all_logits), elapsed / len(inputs)
+
+reference_model = GPT.load(ckpt, device=device, precision="fp32")
+reference_model.eval()
+
+if text_file:
+    vocab = Vocabulary.load(vocab_file)
+    with open(text_file) as f:
+        inputs = [vocab.encode(line)[:input_length] for line in f.read().split("\n") if line.strip()][:num_inputs]
+else:
+    inputs = torch.randint(0, reference_model.config.vocab_size, (num_inputs, input_length)).tolist()
+
+reference, reference_time = run(reference_model, device)
+del reference_model
+reference_log_probs = F.log_softmax(reference, dim=-1)
+
+print(f"{'precision':14s} {'device':6s} {'max abs':>9s} {'mean abs':>9s} {'kl':>9s} {'top-1':>7s} {'ms/input':>9s}")
+print(f"{'fp32':14s} {device:6s} {0:9.4f} {0:9.5f} {0:9.6f} {1:7.2%} {reference_time * 1000:9.1f}")
+for precision in filter(None, precisions.split(",")):
+    if precision == "fp32":
+        continue
+    precision_device = "cpu" if precision.startswith("int8") else device
+    model = GPT.load(ckpt, device=precision_device, precision=precision)
+    model.eval()
+    logits, elapsed = run(model, precision_device)
+    del model
+    diff = (logits - reference).abs()
+    log_probs = F.log_softmax(logits, dim=-1)
+    kl = F.kl_div(log_probs, reference_log_probs, log_target=True, reduction="batchmean").item()
+    top1 = (logits.argmax(dim=-1) == reference.argmax(dim=-1)).float().mean().item()
+    print(f"{precision:14s} {precision_device:6s} {diff.max().item():9.4f} {diff.mean().item():9.5f} {kl:9.6f} {top1:7.2%} {elapsed * 1000:9.1f}")
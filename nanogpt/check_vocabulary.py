@@ -0,0 +1,64 @@
+"""
+Differential test of the vocabulary encoders: checks that the heap-based
+Vocabulary.encode produces exactly the same token ids as the reference
+Vocabulary.encode_scan, on random strings and optionally on a text file.
+$ python check_vocabulary.py --vocab_file=fineweb2.vocab --text_file=some.txt
+"""
+import random
+import time
+from vocabulary import Vocabulary
+
+# -----------------------------------------------------------------------------
+vocab_file = "fineweb2.vocab"
+text_file = "" # optional file whose lines are checked in addition to random strings
+num_random = 500 # number of random strings to check
+max_random_len = 200
+seed = 1337
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+random.seed(seed)
+vocab = Vocabulary.load(vocab_file)
+
+ALPHABET = "aeinrstuhdlcgmobwfkzpvjyxqAEINRSTUHDLCGMOBWFKZPVJYXQäöüßÄÖÜ0123456789 .,;:!?()-\n\t*#\"'éèçñ€😀日本"
+
+def random_string() -> str:
+    length = random.randint(0, max_random_len)
+    if random.random() < 0.3:
+        # repetitive strings stress overlapping pairs like "aaaa"
+        return random.choice(ALPHABET) * length
+    return "".join(random.choice(ALPHABET) for _ in range(length))
+
+inputs = [random_string() for _ in range(num_random)]
+if text_file:
+    with open(text_file) as f:
+        inputs.extend(f.read().split("\n"))
+
+num_merges = len(vocab.merge_rules)
+failures = 0
+time_heap = 0.0
+time_scan = 0.0
+for text in inputs:
+    options = [
+        dict(),
+        dict(reverse=True),
+        dict(add_eot=True),
+        dict(reverse=True, add_eot=True),
+        dict(last_applied_merge_rule=256 + random.randint(0, num_merges)),
+    ]
+    for kwargs in options:
+        t0 = time.perf_counter()
+        expected = vocab.encode_scan(text, **kwargs)
+        t1 = time.perf_counter()
+        actual = vocab.encode(text, **kwargs)
+        t2 = time.perf_counter()
+        time_scan += t1 - t0
+        time_heap += t2 - t1
+        if expected != actual:
+            failures += 1
+            print(f"MISMATCH for {text!r} {kwargs}:\n  scan: {expected}\n  heap: {actual}")
+
+print(f"checked {len(inputs)} inputs, {failures} mismatches")
+print(f"encode_scan: {time_scan:.3f}s, encode: {time_heap:.3f}s")
+if failures:
+    exit(1)
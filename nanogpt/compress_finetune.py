@@ -0,0 +1,92 @@
+"""
+Stores finetunes as compressed deltas against their base checkpoint and
+reports the reconstruction error of each one.
+$ python compress_finetune.py --base_ckpt=output/causal-fw2/ckpt_300000.pt \
+    --finetunes=output/causal-fw2-laws1/ckpt_301000.pt,output/causal-fw2-wikipedia1/ckpt_400000.pt
+Every finetune's delta is written next to it as delta_<iter>.pt and can be
+loaded with GPT.load_delta(path, base_model).
+"""
+import dataclasses
+import os
+import torch
+from gpt import GPT, delta_tensor, quantize_int8
+
+# -----------------------------------------------------------------------------
+base_ckpt = "output/causal-fw2/ckpt_300000.pt"
+finetunes = "" # comma separated finetune checkpoints of base_ckpt
+method = "lowrank" # 'lowrank': truncated svd, applied on the fly; 'int8': per-row quantized, applied at load time
+rank = 64 # rank of the lowrank deltas
+dtype = "bfloat16" # storage dtype of the lowrank factors
+device = "cpu"
+num_check_tokens = 256 # length of the random input for the logit comparison
+seed = 1337
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+torch.manual_seed(seed)
+ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+
+def compress(delta):
+    if delta.dim() != 2:
+        # layer norm weights and biases are tiny, keep them as they are
+        return {'kind': 'dense', 'delta': delta}
+    if method == 'lowrank':
+        U, S, Vh = torch.linalg.svd(delta.float(), full_matrices=False)
+        r = min(rank, S.numel())
+        return {'kind': 'lowrank', 'u': (U[:, :r] * S[:r]).to(ptdtype), 'v': Vh[:r].to(ptdtype)}
+    if method == 'int8':
+        q, scale = quantize_int8(delta)
+        return {'kind': 'int8', 'q': q, 'scale': scale}
+    raise ValueError(f"unknown method {method}")
+
+def entry_bytes(entry):
+    return sum(t.numel() * t.element_size() for t in entry.values() if isinstance(t, torch.Tensor))
+
+base = GPT.load(base_ckpt, device=device)
+base.eval()
+check_input = torch.randint(0, base.config.vocab_size, (1, min(num_check_tokens, base.config.block_size)), device=device)
+with torch.no_grad():
+    base_logits, _ = base(check_input, return_all_logits=True)
+
+for finetune_ckpt in filter(None, finetunes.split(",")):
+    finetune = GPT.load(finetune_ckpt, device=device)
+    finetune.eval()
+    assert finetune.config == base.config, f"{finetune_ckpt} doesn't match the config of {base_ckpt}"
+
+    deltas = {}
+    full_bytes = 0
+    delta_bytes = 0
+    error_sq = 0.0
+    norm_sq = 0.0
+    print(f"{finetune_ckpt}:")
+    with torch.no_grad():
+        for name, param in finetune.named_parameters():
+            full_bytes += param.numel() * 4
+            delta = param.float() - base.get_parameter(name).float()
+            if not delta.any():
+                continue
+            entry = compress(delta)
+            deltas[name] = entry
+            delta_bytes += entry_bytes(entry)
+            error = (delta_tensor(entry) - delta).norm().item()
+            error_sq += error ** 2
+            norm_sq += delta.norm().item() ** 2
+            print(f"  {name:40s} {error / max(delta.norm().item(), 1e-12):8.2%} of the delta, {error / param.float().norm().item():8.4%} of the weight")
+
+    directory, filename = os.path.split(finetune_ckpt)
+    out_path = os.path.join(directory, filename.replace("ckpt_", "delta_", 1))
+    torch.save({
+        'model_args': {f.name: getattr(finetune.config, f.name) for f in dataclasses.fields(finetune.config) if f.init},
+        'base': base_ckpt,
+        'deltas': deltas,
+    }, out_path)
+
+    with torch.no_grad():
+        finetune_logits, _ = finetune(check_input, return_all_logits=True)
+        restored = GPT.load_delta(out_path, base)
+        restored_logits, _ = restored(check_input, return_all_logits=True)
+    divergence = (restored_logits - finetune_logits).abs()
+    print(f"  total: {error_sq ** 0.5 / max(norm_sq ** 0.5, 1e-12):.2%} of the delta, {delta_bytes / 1e6:.1f} MB instead of {full_bytes / 1e6:.1f} MB")
+    print(f"  logits: max abs error {divergence.max().item():.4f}, mean {divergence.mean().item():.5f}"
+          f" (finetune vs base: max {(finetune_logits - base_logits).abs().max().item():.4f})")
+    print(f"  -> {out_path}")
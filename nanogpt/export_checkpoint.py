@@ -0,0 +1,35 @@
+"""
+Exports training checkpoints to weights-only serving checkpoints: no optimizer
+state, no _orig_mod. prefixes, optionally in bfloat16. GPT.load picks up the
+export (ckpt_<iter>.serving.pt next to ckpt_<iter>.pt) automatically and
+memory-maps it.
+$ python export_checkpoint.py --ckpts=output/causal-fw2/ckpt_300000.pt,output/anticausal-fw2/ckpt_300000.pt --dtype=bfloat16
+"""
+import os
+import torch
+from gpt import normalize_state_dict, serving_path
+
+# -----------------------------------------------------------------------------
+ckpts = "" # comma separated training checkpoints
+dtype = "float32" # 'float32' or 'bfloat16'
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16}[dtype]
+
+for ckpt_path in filter(None, ckpts.split(",")):
+    checkpoint = torch.load(ckpt_path, map_location="cpu", mmap=True, weights_only=True)
+    state_dict = {}
+    converted = {} # keeps tied weights (wte and lm_head) a single tensor
+    for k, v in normalize_state_dict(checkpoint['model']).items():
+        key = (v.untyped_storage().data_ptr(), v.storage_offset(), v.shape)
+        if key not in converted:
+            converted[key] = v.to(ptdtype) if v.is_floating_point() else v.clone()
+        state_dict[k] = converted[key]
+    out_path = serving_path(ckpt_path)
+    torch.save({
+        'model_args': checkpoint['model_args'],
+        'iter_num': checkpoint.get('iter_num'),
+        'model': state_dict,
+    }, out_path)
+    print(f"{ckpt_path} ({os.path.getsize(ckpt_path) / 1e6:.1f} MB) -> {out_path} ({os.path.getsize(out_path) / 1e6:.1f} MB)")
@@ -10,11 +10,10 @@ vocab = Vocabulary.load("fineweb2.vocab")
 
 n = 100
 
-result = []
+windows = []
 for i in range(n):
     random_idx = randint(0, len(data) // 2)
-    tokens = data[random_idx:random_idx+100]
-    result_str = vocab.decode(list(tokens))
-    result.append(result_str)
+    windows.append(data[random_idx:random_idx+100])
+result = vocab.decode_batch(windows)
 
 print(json.dumps(result))
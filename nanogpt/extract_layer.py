@@ -1,4 +1,4 @@
-from gpt import GPTConfig, GPT
+from gpt import GPT
 import gc
 from tqdm import tqdm
 import itertools
@@ -26,15 +26,7 @@ for model_id in tqdm(bracex.expand("{anti,}causal-fw2-{gutenberg,wikipedia}1")):
     print(model_id)
     model_name = model_id + ".pt"
     ckpt_path = os.path.join(out_dir, model_name)
-    checkpoint = torch.load(ckpt_path, map_location=device, weights_only=True)
-    gptconf = GPTConfig(**checkpoint['model_args'])
-    model = GPT(gptconf)
-    state_dict = checkpoint['model']
-    unwanted_prefix = '_orig_mod.'
-    for k,v in list(state_dict.items()):
-        if k.startswith(unwanted_prefix):
-            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
-    model.load_state_dict(state_dict)
+    model = GPT.load(ckpt_path, device=device)
 
     model.eval()
 
@@ -1,4 +1,4 @@
-from gpt import GPTConfig, GPT
+from gpt import GPT
 import json
 from matplotlib import pyplot as plt
 from tqdm import tqdm
@@ -21,15 +21,7 @@ def extract_embeddings():
     for model_name in tqdm(models):
         path = os.path.join(input_directory, model_name)
         if not os.path.isfile(path): continue
-        checkpoint = torch.load(path, map_location=device, weights_only=True)
-        gptconf = GPTConfig(**checkpoint['model_args'])
-        model = GPT(gptconf)
-        state_dict = checkpoint['model']
-        unwanted_prefix = '_orig_mod.'
-        for k,v in list(state_dict.items()):
-            if k.startswith(unwanted_prefix):
-                state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
-        model.load_state_dict(state_dict)
+        model = GPT.load(path, device=device)
 
         model.eval()
 
@@ -85,6 +85,7 @@ def yellow_gradient(t):
 def main():
     model = GPT.load("output/anticausal-fw2.pt")
     vocab = Vocabulary.load("fineweb2.vocab")
+    vocab.set_encode_cache(1024)
 
     logits = torch.zeros(len(LÄNDER), 50304)
     for land_id, land in enumerate(LÄNDER):
@@ -1,6 +1,5 @@
 
 import json
-from math import inf
 import re
 from gpt import GPT
 import torch
@@ -114,12 +113,9 @@ def is_correct(country, last_token, vocab):
 
 def main():
     vocab = Vocabulary.load("fineweb2.vocab")
+    vocab.set_encode_cache(1024)
 
-    token_mask = torch.zeros(50304)
-    for token in range(50256):
-        string = vocab.decode([token])
-        if re.match(EXCLUDE_EXPR, string):
-            token_mask[token] = -inf
+    token_mask = vocab.token_mask(EXCLUDE_EXPR, size=50304, exclude=True)
 
     print(token_mask)
 
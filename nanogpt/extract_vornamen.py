@@ -3,7 +3,6 @@ import numpy as np
 import json
 from scipy import stats
 from collections import defaultdict
-from math import inf
 from torch.nn import functional as F
 from tqdm import tqdm
 from vocabulary import Vocabulary
@@ -100,11 +99,7 @@ NECESSARY_EXPR = re.compile(r"^[0-9]{0,3}$")
 def main():
     vocab = Vocabulary.load("fineweb2.vocab")
 
-    token_mask = torch.zeros(50304).to("cuda")
-    for token in range(50256):
-        string = vocab.decode([token])
-        if not re.match(INCLUDE_EXPR, string):
-            token_mask[token] = -inf
+    token_mask = vocab.token_mask(INCLUDE_EXPR, size=50304, device="cuda")
 
     print(token_mask)
 
@@ -116,20 +111,21 @@ def main():
     for vorname in bar:
         bar.set_description(vorname)
         results = defaultdict(float)
+        prompt = f"# {vorname} Müller\n\n{vorname} Müller (* 20. September "
+        prompt_ids = vocab.encode(prompt)
         continuations: set[tuple[tuple[int, ...], float]] = {((), 1.0)}
         while continuations:
           (tokens, prob) = continuations.pop()
           if prob < 1e-4:
               continue
           string = vocab.decode(list(tokens))
-          input_string = f"# {vorname} Müller\n\n{vorname} Müller (* 20. September {string}"
           if re.match(COMPLETE_YEAR, string):
             year = int(string[:4])
             results[year] += prob
           if not re.match(NECESSARY_EXPR, string):
             continue
 
-          model_x = torch.tensor([vocab.encode(input_string)]).to("cuda")
+          model_x = torch.tensor([vocab.encode_incremental(prompt, prompt_ids, string)]).to("cuda")
           model_y, _ = model(model_x)
 
           probs_vorname = F.softmax(model_y[0][0] + token_mask, dim = -1)
@@ -32,6 +32,7 @@ num_samples = 16 # number of samples to draw
 max_new_tokens = int(350) # number of tokens generated in each sample
 temperature = 0.7 # 1.0 = no change, < 1.0 = less random, > 1.0 = more random, in predictions
 top_k = 200 # retain only the top_k most likely tokens, clamp others to have 0 probability
+window_stride = 256 # past block_size, refill the kv cache every this many tokens instead of recomputing every token
 
 seed = random.randint(0, int(1e10))
 print(f"Using seed {seed}")
@@ -51,6 +52,17 @@ if compile:
 
 vocab = Vocabulary.load(vocab_file)
 
+def generate_samples(start_ids, n):
+    """ n continuations of start_ids, in one batch if prompt and continuation fit into the block size """
+    if len(start_ids) + max_new_tokens <= model.config.block_size:
+        return model.generate_batch([start_ids] * n, max_new_tokens, temperature=temperature, top_k=top_k)
+    # longer ones need the sliding window of generate, one sample at a time
+    x = torch.tensor(start_ids, dtype=torch.long, device=device)[None, ...]
+    return [
+        model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k, window_stride=window_stride)[0]
+        for _ in range(n)
+    ]
+
 # encode the beginning of the prompt
 prompt_input = True
 while prompt_input:
@@ -102,20 +114,9 @@ while prompt_input:
                     decoded = vocab.decode(tokens, reverse=causality=="anticausal")
                     print(f"{prob:.3f} {decoded}")
         elif show_token_generation_probs:
-            idx = x
             res = []
-            for _ in range(max_new_tokens):
-                logits, _ = model(idx)
-                logits = logits[:, -1, :] / temperature
-                if top_k is not None:
-                    v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
-                    logits[logits < v[:, [-1]]] = -float('Inf')
-                probs = F.softmax(logits, dim=-1)
-                idx_next = torch.multinomial(probs, num_samples=1)
-                prob = probs[0][idx_next]
-                res.append((float(prob), idx_next[0]))
-                idx = torch.cat((idx, idx_next), dim=1)
-            idx = idx[0][len(x):].tolist()
+            for (tokens,), (probs,) in model.generate_chunks(x, max_new_tokens, temperature=temperature, top_k=top_k, chunk_size=max_new_tokens, return_probs=True, window_stride=window_stride):
+                res.extend(zip(probs, tokens))
             print()
             for prob, token_id in res:
                 print(f"{prob:.3f}", vocab.decode([int(token_id)]).replace("\n", "␤").replace(" ", "⎵"))
@@ -125,8 +126,7 @@ while prompt_input:
             results = []
             try:
                 for _ in tqdm(range(0, num_samples, 32)):
-                    x = torch.tensor([x[0].tolist()] * 32, dtype=torch.long, device=device)
-                    gen = model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k)
+                    gen = generate_samples(start_ids, 32)
                     for item in gen:
                         results.append(vocab.decode(item, reverse = causality == "anticausal" ))
             finally:
@@ -134,7 +134,7 @@ while prompt_input:
                     json.dump(results, f)
 
         elif causality == 'causal':
-            gen = model.generate_generator(x, max_new_tokens, temperature=temperature, top_k=top_k)
+            gen = model.generate_generator(x, max_new_tokens, temperature=temperature, top_k=top_k, window_stride=window_stride)
             print()
             print(prompt_input, end="", flush=True)
             colored = False
@@ -158,12 +158,11 @@ while prompt_input:
                 continue
             print()
         # elif causality == 'anticausal':
-        #     y = model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k)
+        #     y = model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k, window_stride=window_stride)
         #     string = vocab.decode(y[0], reverse=True)
         #     print(string + prompt_input)
         elif causality == 'anticausal':
-            x_batch = torch.tensor([x[0].tolist()] * num_samples, dtype=torch.long, device=device)
-            y_batch = model.generate(x_batch, max_new_tokens, temperature=temperature, top_k=top_k)
+            y_batch = generate_samples(start_ids, num_samples)
             for y in y_batch:
                 string = vocab.decode(y, reverse=True)
                 print("=" * 50)
@@ -6,7 +6,7 @@ import numpy as np
 from contextlib import nullcontext
 import torch
 import random
-from gpt import GPTConfig, GPT
+from gpt import GPT
 from tqdm import tqdm
 import bracex
 
@@ -41,15 +41,7 @@ ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torc
 ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
 
 ckpt_path = f"/output/{model_name}/ckpt_{ckpt_value}.pt"
-checkpoint = torch.load(ckpt_path, map_location=device, weights_only=True)
-gptconf = GPTConfig(**checkpoint['model_args'])
-model = GPT(gptconf)
-state_dict = checkpoint['model']
-unwanted_prefix = '_orig_mod.'
-for k,v in list(state_dict.items()):
-    if k.startswith(unwanted_prefix):
-        state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
-model.load_state_dict(state_dict)
+model = GPT.load(ckpt_path, device=device)
 
 model.eval()
 model.to(device)
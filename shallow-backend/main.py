@@ -1,6 +1,6 @@
 import logging
 from typing import cast
-from fastapi import FastAPI, HTTPException, Depends, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Depends, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy import create_engine, text
@@ -10,7 +10,7 @@ import numpy as np
 import json
 import websockets
 import requests
-from models import GeminiColumnRequest, LogitsRequest, RequestUnion, InferenceRequest, BirthyearRequest, ForcingRequest
+from models import GeminiColumnRequest, LogitsRequest, RequestUnion, InferenceRequest, BirthyearRequest, ForcingRequest, CompareRequest
 from vocabulary import Vocabulary
 from validate import validate_model_name
 from sklearn.neighbors import NearestNeighbors
@@ -228,13 +228,28 @@ async def websocket_endpoint(client_ws: WebSocket):
             del active_clients[request_id]  # Cleanup
 
 
-@app.post("/v0/model/{model_name}/logits")
-async def model_logits(model_name: str, request: LogitsRequest):
+# headers of a logits request and response that are relayed as they are
+LOGITS_REQUEST_HEADERS = ("Accept",)
+LOGITS_RESPONSE_HEADERS = ("Content-Type", "Content-Encoding")
 
-    return requests.post(
+
+@app.post("/v0/model/{model_name}/logits")
+async def model_logits(model_name: str, request: LogitsRequest, http_request: Request):
+    # the (possibly binary and compressed) body is passed through without decoding
+    headers = {name: http_request.headers[name] for name in LOGITS_REQUEST_HEADERS if name in http_request.headers}
+    # always explicit, requests would otherwise ask for gzip on the client's behalf
+    headers["Accept-Encoding"] = http_request.headers.get("Accept-Encoding", "identity")
+    response = requests.post(
         DEEP_URL_HTTP + "/model/" + model_name + "/logits",
         json=jsonable_encoder(request),
-    ).json()
+        headers=headers,
+        stream=True,
+    )
+    return Response(
+        content=response.raw.read(decode_content=False),
+        status_code=response.status_code,
+        headers={name: response.headers[name] for name in LOGITS_RESPONSE_HEADERS if name in response.headers},
+    )
 
 @app.post("/v0/birthyear")
 async def birthyear(request: BirthyearRequest):
@@ -250,3 +265,12 @@ async def forcing(model_name: str, request: ForcingRequest):
         DEEP_URL_HTTP + "/model/" + model_name + "/forcing",
         json=jsonable_encoder(request),
     ).json()
+
+@app.post("/v0/compare")
+async def compare(request: CompareRequest):
+    for model_name in request.model_ids:
+        validate_model_name(model_name)
+    return requests.post(
+        DEEP_URL_HTTP + "/compare",
+        json=jsonable_encoder(request),
+    ).json()
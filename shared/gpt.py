@@ -9,6 +9,8 @@ https://github.com/huggingface/transformers/blob/main/src/transformers/models/gp
 
 import math
 import inspect
+import os
+from collections import OrderedDict
 from dataclasses import dataclass, field
 from typing import Optional, Self
 from contextlib import nullcontext
@@ -28,6 +30,297 @@ class LayerNorm(nn.Module):
     def forward(self, input):
         return F.layer_norm(input, self.weight.shape, self.weight, self.bias, 1e-5)
 
+class LowRankDelta(nn.Module):
+    """ A (shared) base Linear plus the low-rank weight delta u @ v, applied on the fly """
+
+    def __init__(self, base, u, v, bias=None):
+        super().__init__()
+        self.base = base
+        self.u = nn.Parameter(u, requires_grad=False) # (out_features, rank)
+        self.v = nn.Parameter(v, requires_grad=False) # (rank, in_features)
+        self.bias = None if bias is None else nn.Parameter(bias, requires_grad=False) # full bias of the finetune
+
+    def forward(self, input):
+        y = F.linear(input, self.base.weight, self.bias if self.bias is not None else self.base.bias)
+        return y + F.linear(F.linear(input, self.v), self.u)
+
+class LowRankDeltaEmbedding(nn.Module):
+    """ A (shared) base Embedding plus the low-rank weight delta u @ v, applied on the fly """
+
+    def __init__(self, base, u, v):
+        super().__init__()
+        self.base = base
+        self.u = nn.Parameter(u, requires_grad=False) # (num_embeddings, rank)
+        self.v = nn.Parameter(v, requires_grad=False) # (rank, embedding_dim)
+
+    def forward(self, input):
+        return self.base(input) + F.embedding(input, self.u) @ self.v
+
+def quantize_int8(weight):
+    """ symmetric per-row int8 quantization, returns the int8 weight and the row scales """
+    weight = weight.float()
+    scale = weight.abs().amax(dim=1).clamp(min=1e-12) / 127
+    return torch.round(weight / scale[:, None]).clamp(-127, 127).to(torch.int8), scale
+
+class Int8Linear(nn.Module):
+    """ Weight-only int8 Linear, the weight is dequantized on the fly in every forward """
+
+    def __init__(self, linear):
+        super().__init__()
+        weight, scale = quantize_int8(linear.weight.detach())
+        self.register_buffer('weight_int8', weight)
+        self.register_buffer('scale', scale)
+        self.bias = linear.bias
+
+    def forward(self, input):
+        weight = self.weight_int8.to(input.dtype) * self.scale.to(input.dtype)[:, None]
+        return F.linear(input, weight, self.bias)
+
+def delta_tensor(entry):
+    """ the dense delta of one entry of a delta checkpoint (see nanogpt/compress_finetune.py) """
+    if entry['kind'] == 'lowrank':
+        return entry['u'].float() @ entry['v'].float()
+    if entry['kind'] == 'int8':
+        return entry['q'].float() * entry['scale'].float()[:, None]
+    return entry['delta'].float()
+
+PRECISIONS = ('fp32', 'bf16', 'int8-dynamic', 'int8-weight')
+
+SERVING_SUFFIX = '.serving.pt'
+
+def serving_path(ckpt_path: str) -> str:
+    """ where export_checkpoint.py puts the serving checkpoint of ckpt_path """
+    if ckpt_path.endswith(SERVING_SUFFIX):
+        return ckpt_path
+    return os.path.splitext(ckpt_path)[0] + SERVING_SUFFIX
+
+def normalize_state_dict(state_dict):
+    # checkpoints of compiled models prefix every key with _orig_mod.
+    unwanted_prefix = '_orig_mod.'
+    return {k[len(unwanted_prefix):] if k.startswith(unwanted_prefix) else k: v for k, v in state_dict.items()}
+
+class LayerKVCache:
+    """ Keys and values of one attention layer, preallocated for max_length positions """
+
+    def __init__(self, max_length):
+        self.max_length = max_length
+        self.k = None
+        self.v = None
+        self.length = 0
+
+    def update(self, k, v):
+        # append k, v of shape (B, nh, T, hs) and return all cached keys and values
+        if self.k is None:
+            B, nh, _, hs = k.size()
+            self.k = k.new_empty(B, nh, self.max_length, hs)
+            self.v = v.new_empty(B, nh, self.max_length, hs)
+        end = self.length + k.size(2)
+        assert end <= self.max_length, f"KV cache overflow: {end} > {self.max_length}"
+        self.k[:, :, self.length:end] = k
+        self.v[:, :, self.length:end] = v
+        self.length = end
+        return self.k[:, :, :end], self.v[:, :, :end]
+
+class KVCache:
+    """
+    Per-layer key/value cache for incremental decoding. Positions are absolute,
+    so a cache can hold at most block_size positions.
+    """
+
+    def __init__(self, config, max_length=None):
+        max_length = max_length or config.block_size
+        assert max_length <= config.block_size
+        self.layers = [LayerKVCache(max_length) for _ in range(config.n_layer)]
+
+    @property
+    def length(self):
+        return self.layers[0].length
+
+    def reset(self):
+        # forget all positions but keep the allocated buffers
+        for layer in self.layers:
+            layer.length = 0
+
+    def select(self, rows):
+        # keep only the given batch rows (LongTensor of row indices)
+        for layer in self.layers:
+            if layer.k is not None:
+                layer.k = layer.k.index_select(0, rows)
+                layer.v = layer.v.index_select(0, rows)
+
+    @property
+    def max_length(self):
+        return self.layers[0].max_length
+
+    def pad_left(self, n):
+        # insert n empty positions in front of the cached ones
+        assert self.length + n <= self.max_length, f"KV cache overflow: {self.length + n} > {self.max_length}"
+        for layer in self.layers:
+            if layer.k is not None:
+                for buffer in (layer.k, layer.v):
+                    buffer[:, :, n:n + layer.length] = buffer[:, :, :layer.length].clone()
+                    buffer[:, :, :n] = 0
+            layer.length += n
+
+    def drop_left(self, n):
+        # forget the first n cached positions
+        for layer in self.layers:
+            if layer.k is not None:
+                for buffer in (layer.k, layer.v):
+                    buffer[:, :, :layer.length - n] = buffer[:, :, n:layer.length].clone()
+            layer.length -= n
+
+    def merge(self, other):
+        # append the rows of other, which has to hold as many positions
+        assert self.length == other.length and self.max_length == other.max_length
+        for layer, other_layer in zip(self.layers, other.layers):
+            layer.k = torch.cat((layer.k, other_layer.k))
+            layer.v = torch.cat((layer.v, other_layer.v))
+
+@dataclass
+class PrefixCacheInfo:
+    hit_tokens: int
+    miss_tokens: int
+    max_bytes: int
+    bytes: int
+    entries: int
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hit_tokens + self.miss_tokens
+        return self.hit_tokens / total if total else 0.0
+
+class PrefixCacheNode:
+    """ A run of tokens in the prefix trie with their keys and values of all layers """
+    __slots__ = ('tokens', 'k', 'v', 'parent', 'children')
+
+    def __init__(self, tokens, k, v, parent):
+        self.tokens = tokens # tuple of token ids
+        self.k = k # (n_layer, nh, len(tokens), hs)
+        self.v = v
+        self.parent = parent
+        self.children = {} # first token -> node
+
+    @property
+    def nbytes(self):
+        return 0 if self.k is None else 2 * self.k.numel() * self.k.element_size()
+
+class PrefixCache:
+    """
+    Keeps the keys and values of previously forwarded token sequences of a
+    (batch size one) GPT in a trie, so forwarding a sequence that shares a
+    prefix with an earlier one only computes the uncached suffix. Nodes hold
+    runs of tokens and are split where sequences diverge. Once the cache holds
+    more than max_bytes, the least recently used leaves are evicted.
+    """
+
+    def __init__(self, model, max_bytes=256 * 1024 * 1024):
+        self.model = model
+        self.max_bytes = max_bytes
+        self.root = PrefixCacheNode((), None, None, None)
+        self.lru = OrderedDict() # node -> None, least recently used first
+        self.bytes = 0
+        self.hit_tokens = 0
+        self.miss_tokens = 0
+
+    def info(self) -> PrefixCacheInfo:
+        return PrefixCacheInfo(self.hit_tokens, self.miss_tokens, self.max_bytes, self.bytes, len(self.lru))
+
+    def clear(self):
+        self.root = PrefixCacheNode((), None, None, None)
+        self.lru.clear()
+        self.bytes = 0
+
+    @torch.no_grad()
+    def forward(self, idx):
+        """ Returns the logits (1, 1, vocab_size) at the last position of idx (shape (1, t)) """
+        assert idx.size(0) == 1, "the prefix cache only handles batches of one sequence"
+        tokens = tuple(idx[0].tolist())
+        # at least the last token has to be forwarded to get its logits
+        cached, ks, vs = self.lookup(tokens[:-1])
+        self.hit_tokens += cached
+        self.miss_tokens += len(tokens) - cached
+
+        kv_cache = KVCache(self.model.config, max_length=len(tokens))
+        if cached:
+            k, v = torch.cat(ks, dim=2), torch.cat(vs, dim=2)
+            for i, layer in enumerate(kv_cache.layers):
+                layer.update(k[i][None], v[i][None])
+        with self.model.config.ctx or nullcontext():
+            logits, _ = self.model(idx[:, cached:], kv_cache=kv_cache)
+        self.insert(tokens, kv_cache)
+        self.evict()
+        return logits
+
+    def lookup(self, tokens):
+        # returns the number of cached leading tokens and their keys and values
+        node, pos = self.root, 0
+        ks, vs = [], []
+        while pos < len(tokens):
+            child = node.children.get(tokens[pos])
+            if child is None:
+                break
+            n = common_prefix_length(child.tokens, tokens[pos:])
+            self.touch(child)
+            ks.append(child.k[:, :, :n])
+            vs.append(child.v[:, :, :n])
+            pos += n
+            if n < len(child.tokens):
+                break
+            node = child
+        return pos, ks, vs
+
+    def insert(self, tokens, kv_cache):
+        node, pos = self.root, 0
+        while pos < len(tokens):
+            child = node.children.get(tokens[pos])
+            if child is None:
+                k = torch.stack([layer.k[0, :, pos:len(tokens)] for layer in kv_cache.layers])
+                v = torch.stack([layer.v[0, :, pos:len(tokens)] for layer in kv_cache.layers])
+                child = PrefixCacheNode(tokens[pos:], k, v, node)
+                node.children[tokens[pos]] = child
+                self.bytes += child.nbytes
+                self.touch(child)
+                return
+            n = common_prefix_length(child.tokens, tokens[pos:])
+            if n < len(child.tokens):
+                child = self.split(child, n)
+            self.touch(child)
+            node, pos = child, pos + n
+
+    def split(self, node, n):
+        # split node after its first n tokens and return the new upper node
+        upper = PrefixCacheNode(node.tokens[:n], node.k[:, :, :n].clone(), node.v[:, :, :n].clone(), node.parent)
+        self.bytes -= node.nbytes
+        node.tokens = node.tokens[n:]
+        node.k = node.k[:, :, n:].clone()
+        node.v = node.v[:, :, n:].clone()
+        node.parent.children[upper.tokens[0]] = upper
+        node.parent = upper
+        upper.children[node.tokens[0]] = node
+        self.bytes += upper.nbytes + node.nbytes
+        self.touch(upper)
+        return upper
+
+    def touch(self, node):
+        self.lru[node] = None
+        self.lru.move_to_end(node)
+
+    def evict(self):
+        while self.bytes > self.max_bytes and self.lru:
+            node = next(node for node in self.lru if not node.children)
+            del self.lru[node]
+            del node.parent.children[node.tokens[0]]
+            self.bytes -= node.nbytes
+
+def common_prefix_length(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
 class CausalSelfAttention(nn.Module):
 
     def __init__(self, config):
@@ -51,7 +344,7 @@ class CausalSelfAttention(nn.Module):
             self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size))
                                         .view(1, 1, config.block_size, config.block_size))
 
-    def forward(self, x):
+    def forward(self, x, kv_cache: Optional[LayerKVCache] = None, attn_mask=None):
         B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
@@ -60,14 +353,27 @@ class CausalSelfAttention(nn.Module):
         q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
         v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
 
-        # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
+        # with a kv cache, the T new queries attend to the past positions and the new ones
+        past = 0
+        if kv_cache is not None:
+            past = kv_cache.length
+            k, v = kv_cache.update(k, v) # (B, nh, past + T, hs)
+
+        # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, past + T) -> (B, nh, T, past + T)
+        # an explicit attn_mask (bool, True = attend) replaces the causal mask
         if self.flash:
             # efficient attention using Flash Attention CUDA kernels
-            y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=None, dropout_p=self.dropout if self.training else 0, is_causal=True)
+            is_causal = attn_mask is None and past == 0
+            if attn_mask is None and past > 0 and T > 1:
+                # query i sits at position past + i, is_causal would align it to key i
+                attn_mask = torch.ones(T, past + T, dtype=torch.bool, device=x.device).tril(diagonal=past)
+            y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=self.dropout if self.training else 0, is_causal=is_causal)
         else:
             # manual implementation of attention
             att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-            att = att.masked_fill(self.bias[:,:,:T,:T] == 0, float('-inf'))
+            if attn_mask is None:
+                attn_mask = self.bias[:,:,past:past + T,:past + T] != 0
+            att = att.masked_fill(~attn_mask, float('-inf'))
             att = F.softmax(att, dim=-1)
             att = self.attn_dropout(att)
             y = att @ v # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
@@ -102,8 +408,8 @@ class Block(nn.Module):
         self.ln_2 = LayerNorm(config.n_embd, bias=config.bias)
         self.mlp = MLP(config)
 
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x))
+    def forward(self, x, kv_cache: Optional[LayerKVCache] = None, attn_mask=None):
+        x = x + self.attn(self.ln_1(x), kv_cache=kv_cache, attn_mask=attn_mask)
         x = x + self.mlp(self.ln_2(x))
         return x
 
@@ -118,29 +424,115 @@ class GPTConfig:
     bias: bool = False # True: bias in Linears and LayerNorms, like GPT-2. False: a bit better and faster
     ctx: Optional[torch.autocast] = field(default=None, init=False, repr=False, hash=False, compare=False)
 
+@dataclass
+class ScoreResult:
+    """ per-position results of GPT.score, all tensors of shape (b, t) or (b, t, top_k) """
+    log_probs: torch.Tensor # log-probability of the target token
+    ranks: torch.Tensor # number of tokens with a strictly higher log-probability than the target
+    top_ids: torch.Tensor
+    top_log_probs: torch.Tensor
+
 class GPT(nn.Module):
 
     @staticmethod
-    def load(ckpt_path: str, device="cuda", compile=False) -> "GPT":
-        torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
-        torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
-        ctx = torch.amp.autocast(device_type="cuda", dtype=torch.bfloat16)
-        checkpoint = torch.load(ckpt_path, map_location=device, weights_only=True)
+    def load(ckpt_path: str, device="cuda", compile=False, precision=None) -> "GPT":
+        """
+        Load a checkpoint. If a serving sibling (see serving_path) exists and is
+        not older than the checkpoint, it is used instead. Checkpoints are
+        memory-mapped, so only the model weights are ever read and they are
+        copied to the device straight from the file.
+        precision is one of PRECISIONS (see set_precision), by default bf16 on
+        cuda and fp32 elsewhere.
+        """
+        if precision is None:
+            precision = 'bf16' if torch.device(device).type == 'cuda' else 'fp32'
+        if precision != 'fp32':
+            torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
+            torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
+        serving = serving_path(ckpt_path)
+        if os.path.exists(serving) and (
+            not os.path.exists(ckpt_path)
+            or os.path.getmtime(serving) >= os.path.getmtime(ckpt_path)
+        ):
+            ckpt_path = serving
+        checkpoint = torch.load(ckpt_path, map_location="cpu", mmap=True, weights_only=True)
         gptconf = GPTConfig(**checkpoint['model_args'])
-        model = GPT(gptconf)
-        state_dict = checkpoint['model']
-        state_dict = checkpoint['model']
-        unwanted_prefix = '_orig_mod.'
-        for k, _ in list(state_dict.items()):
-            if k.startswith(unwanted_prefix):
-                state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
-        model.load_state_dict(state_dict)
+        with torch.device('meta'):
+            model = GPT(gptconf)
+        model.load_state_dict(normalize_state_dict(checkpoint['model']), assign=True)
+        # assigning replaced the tied parameters one by one
+        model.transformer.wte.weight = model.lm_head.weight
         model.to(device)
-        model.config.ctx = ctx
+        model.set_precision(precision)
         if compile:
             model = torch.compile(model)
         return model
 
+    @staticmethod
+    def load_delta(delta_path: str, base: "GPT", materialize=False) -> "GPT":
+        """
+        Loads a finetune stored as a delta against base. Low-rank deltas of
+        linears and embeddings are applied on the fly and share the base
+        weights, unless materialize is set; all other deltas are added to a
+        copy of the base weight at load time. Parameters without a delta are
+        shared with base.
+        """
+        device = next(base.parameters()).device
+        checkpoint = torch.load(delta_path, map_location=device, weights_only=True)
+        with torch.device('meta'):
+            model = GPT(GPTConfig(**checkpoint['model_args']))
+        deltas = checkpoint['deltas']
+        for name, _ in base.named_parameters():
+            module_name, param_name = name.rsplit('.', 1)
+            module = model.get_submodule(module_name)
+            base_module = base.get_submodule(module_name)
+            base_param = base.get_parameter(name)
+            entry = deltas.get(name)
+            if entry is not None and entry['kind'] == 'lowrank' and param_name == 'weight' and not materialize:
+                if isinstance(base_module, nn.Embedding):
+                    delta_module = LowRankDeltaEmbedding(base_module, entry['u'].to(base_param.dtype), entry['v'].to(base_param.dtype))
+                else:
+                    bias = name[:-len('weight')] + 'bias'
+                    bias = base.get_parameter(bias) + delta_tensor(deltas[bias]).to(base_param.dtype) if bias in deltas else None
+                    delta_module = LowRankDelta(base_module, entry['u'].to(base_param.dtype), entry['v'].to(base_param.dtype), bias)
+                model.set_submodule(module_name, delta_module)
+            elif isinstance(model.get_submodule(module_name), (LowRankDelta, LowRankDeltaEmbedding)):
+                # a bias already folded into its LowRankDelta
+                continue
+            elif entry is not None:
+                setattr(module, param_name, nn.Parameter(base_param + delta_tensor(entry).to(base_param.dtype), requires_grad=False))
+            else:
+                setattr(module, param_name, base_param)
+        # the lm_head shares its weight (and delta) with the token embedding
+        wte = model.transformer.wte
+        if isinstance(wte, LowRankDeltaEmbedding):
+            model.lm_head = LowRankDelta(base.lm_head, wte.u, wte.v)
+        else:
+            model.lm_head.weight = wte.weight
+        model.config.ctx = base.config.ctx
+        return model
+
+    def set_precision(self, precision: str):
+        """
+        fp32: float32 weights, no autocast
+        bf16: bfloat16 autocast (weights are kept as they are)
+        int8-dynamic: float32 weights, linears replaced by dynamically quantized int8 ones (cpu only)
+        int8-weight: linears store int8 weights and compute in float32
+        """
+        assert precision in PRECISIONS, f"unknown precision {precision}, expected one of {PRECISIONS}"
+        device_type = next(self.parameters()).device.type
+        if precision == 'bf16':
+            self.config.ctx = torch.amp.autocast(device_type=device_type, dtype=torch.bfloat16)
+            return
+        self.float()
+        self.config.ctx = None
+        if precision == 'int8-dynamic':
+            assert device_type == 'cpu', "dynamically quantized linears only run on cpu"
+            torch.ao.quantization.quantize_dynamic(self, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        elif precision == 'int8-weight':
+            for name, module in list(self.named_modules()):
+                if isinstance(module, nn.Linear):
+                    self.set_submodule(name, Int8Linear(module))
 
     def __init__(self, config):
         super().__init__()
@@ -192,19 +584,14 @@ class GPT(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def forward(self, idx, targets=None, return_all_logits=False):
-        device = idx.device
-        b, t = idx.size()
-        assert t <= self.config.block_size, f"Cannot forward sequence of length {t}, block size is only {self.config.block_size}"
-        pos = torch.arange(0, t, dtype=torch.long, device=device) # shape (t)
-
-        # forward the GPT model itself
-        tok_emb = self.transformer.wte(idx) # token embeddings of shape (b, t, n_embd)
-        pos_emb = self.transformer.wpe(pos) # position embeddings of shape (t, n_embd)
-        x = self.transformer.drop(tok_emb + pos_emb)
-        for block in self.transformer.h:
-            x = block(x)
-        x = self.transformer.ln_f(x)
+    def forward(self, idx, targets=None, return_all_logits=False, kv_cache: Optional[KVCache] = None, pos=None, attn_mask=None):
+        """
+        With a kv_cache, idx holds only the positions after the cached ones;
+        their keys and values are appended to the cache. pos (shape (b, t))
+        and attn_mask (bool, shape (b, 1, t, past + t)) override the default
+        positions and causal mask, e.g. for left-padded batches.
+        """
+        x = self.hidden_states(idx, kv_cache=kv_cache, pos=pos, attn_mask=attn_mask)
 
         if targets is not None:
             # if we are given some desired targets also calculate the loss
@@ -220,6 +607,67 @@ class GPT(nn.Module):
 
         return logits, loss
 
+    def hidden_states(self, idx, kv_cache: Optional[KVCache] = None, pos=None, attn_mask=None):
+        """ the final hidden states (b, t, n_embd), i.e. everything of forward except the lm_head """
+        device = idx.device
+        b, t = idx.size()
+        past = kv_cache.length if kv_cache is not None else 0
+        assert past + t <= self.config.block_size, f"Cannot forward sequence of length {past + t}, block size is only {self.config.block_size}"
+        if pos is None:
+            pos = torch.arange(past, past + t, dtype=torch.long, device=device) # shape (t)
+
+        # forward the GPT model itself
+        tok_emb = self.transformer.wte(idx) # token embeddings of shape (b, t, n_embd)
+        pos_emb = self.transformer.wpe(pos) # position embeddings of shape (t, n_embd) or (b, t, n_embd)
+        x = self.transformer.drop(tok_emb + pos_emb)
+        for i, block in enumerate(self.transformer.h):
+            x = block(x, kv_cache=kv_cache.layers[i] if kv_cache is not None else None, attn_mask=attn_mask)
+        return self.transformer.ln_f(x)
+
+    @torch.no_grad()
+    def score(self, idx, targets, top_k=0, chunk_size=128, pos=None, attn_mask=None) -> ScoreResult:
+        """
+        Scores targets (shape (b, t), -1 to skip a position) under the
+        predictions for idx without materializing all logits: the lm_head and
+        log_softmax run over chunks of chunk_size positions at a time, and only
+        the target log-probs, their ranks and the top_k alternatives are kept.
+        Skipped positions get a log-prob of 0 and a rank of -1.
+        The results stay on the model's device.
+        """
+        x = self.hidden_states(idx, pos=pos, attn_mask=attn_mask)
+        return self.score_hidden_states(x, targets, top_k=top_k, chunk_size=chunk_size)
+
+    @torch.no_grad()
+    def score_hidden_states(self, x, targets, top_k=0, chunk_size=128) -> ScoreResult:
+        """ GPT.score on the output x (b, t, n_embd) of GPT.hidden_states """
+        b, t, _ = x.size()
+        x = x.reshape(b * t, -1)
+        targets = targets.reshape(b * t)
+        skipped = targets < 0
+        targets = targets.clamp(min=0)
+
+        log_probs = torch.empty(b * t, dtype=torch.float, device=x.device)
+        ranks = torch.empty(b * t, dtype=torch.long, device=x.device)
+        top_ids = torch.empty(b * t, top_k, dtype=torch.long, device=x.device)
+        top_log_probs = torch.empty(b * t, top_k, dtype=torch.float, device=x.device)
+        for start in range(0, b * t, chunk_size):
+            end = min(start + chunk_size, b * t)
+            chunk = F.log_softmax(self.lm_head(x[start:end]).float(), dim=-1)
+            target_log_probs = chunk.gather(1, targets[start:end, None])
+            log_probs[start:end] = target_log_probs[:, 0]
+            ranks[start:end] = (chunk > target_log_probs).sum(dim=-1)
+            if top_k > 0:
+                top_log_probs[start:end], top_ids[start:end] = torch.topk(chunk, top_k, dim=-1)
+
+        log_probs = log_probs.masked_fill(skipped, 0.0)
+        ranks = ranks.masked_fill(skipped, -1)
+        return ScoreResult(
+            log_probs=log_probs.view(b, t),
+            ranks=ranks.view(b, t),
+            top_ids=top_ids.view(b, t, top_k),
+            top_log_probs=top_log_probs.view(b, t, top_k),
+        )
+
     def crop_block_size(self, block_size):
         # model surgery to decrease the block size if necessary
         # e.g. we may load the GPT2 pretrained model checkpoint (block size 1024)
@@ -274,7 +722,7 @@ class GPT(nn.Module):
         return mfu
 
     @torch.no_grad()
-    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None):
+    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None, use_kv_cache=True, window_stride=None):
         """
         Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
         the sequence max_new_tokens times, feeding the predictions back into the model each time.
@@ -287,30 +735,326 @@ class GPT(nn.Module):
                 idx,
                 max_new_tokens,
                 temperature=temperature,
-                top_k=top_k
+                top_k=top_k,
+                use_kv_cache=use_kv_cache,
+                window_stride=window_stride,
             )],
              dim=1
          ).tolist()
 
+    @staticmethod
+    def sample_logits(logits, temperature=1.0, top_k=None, return_probs=False):
+        # scale the final step logits (b, vocab_size) by desired temperature
+        logits = logits / temperature
+        # optionally crop the logits to only the top k options
+        # (masked_fill instead of boolean indexing, which would sync with the host)
+        if top_k is not None:
+            v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
+            logits = logits.masked_fill(logits < v[:, [-1]], -float('Inf'))
+        # apply softmax to convert logits to (normalized) probabilities
+        probs = F.softmax(logits, dim=-1)
+        # sample from the distribution
+        idx_next = torch.multinomial(probs, num_samples=1)
+        if return_probs:
+            return idx_next, probs.gather(1, idx_next)
+        return idx_next
+
+    @torch.no_grad()
+    def generate_generator(self, idx, max_new_tokens, temperature=1.0, top_k=None, use_kv_cache=True, window_stride=None, return_probs=False):
+        """
+        With use_kv_cache the prompt is forwarded once and every further step only
+        forwards the newest token against the cached keys and values.
+
+        Positions are absolute, so the cache can't simply slide once the sequence
+        outgrows block_size. By default every such step then recomputes the last
+        block_size tokens, exactly like without the cache. With window_stride set,
+        a full cache is instead refilled with the last block_size - window_stride
+        tokens and decoding continues incrementally for window_stride more steps.
+        Each token past block_size then sees between block_size - window_stride
+        and block_size - 1 tokens of context instead of exactly block_size - 1,
+        and the cost per token stays at one step plus a refill every
+        window_stride tokens.
+
+        Yields the sampled (b, 1) index tensors, with return_probs also their
+        probabilities. Nothing in the loop waits for the device.
+        """
+        if window_stride is not None:
+            assert use_kv_cache, "window_stride requires use_kv_cache"
+            assert 0 < window_stride < self.config.block_size
+        ctx = self.config.ctx or nullcontext()
+        kv_cache = KVCache(self.config) if use_kv_cache else None
+        # the running sequence lives in a preallocated buffer on the device
+        b, t = idx.size()
+        seq = torch.empty(b, t + max_new_tokens, dtype=idx.dtype, device=idx.device)
+        seq[:, :t] = idx
+        # the autocast context must not stay entered across a yield: the
+        # consumer may run other work on this thread in between
+        for _ in range(max_new_tokens):
+            with ctx:
+                if kv_cache is not None and 0 < kv_cache.length < kv_cache.max_length:
+                    # only forward the newest token, everything before it is cached
+                    logits, _ = self(seq[:, t - 1:t], kv_cache=kv_cache)
+                else:
+                    # if the sequence context is growing too long we must crop it at block_size
+                    context = self.config.block_size
+                    if window_stride is not None and kv_cache.length > 0:
+                        context -= window_stride
+                    idx_cond = seq[:, max(t - context, 0):t]
+                    if kv_cache is not None:
+                        kv_cache.reset()
+                    # forward the model to get the logits for the index in the sequence
+                    logits, _ = self(idx_cond, kv_cache=kv_cache)
+                # pluck the logits at the final step and sample from them
+                sampled = self.sample_logits(logits[:, -1, :], temperature=temperature, top_k=top_k, return_probs=return_probs)
+            idx_next = sampled[0] if return_probs else sampled
+            # append sampled index to the running sequence and continue
+            seq[:, t] = idx_next[:, 0]
+            t += 1
+            yield sampled
+
+    @torch.no_grad()
+    def generate_chunks(self, idx, max_new_tokens, temperature=1.0, top_k=None, chunk_size=16, return_probs=False, window_stride=None):
+        """
+        Like generate_generator, but the sampled tokens are collected in a
+        preallocated device buffer and only copied to the host every chunk_size
+        steps, so the decode loop syncs once per chunk instead of once per token.
+        Yields one list of tokens per batch row for every chunk, with
+        return_probs a pair of that and the matching probabilities.
+        """
+        b = idx.size(0)
+        tokens = torch.empty(b, max_new_tokens, dtype=torch.long, device=idx.device)
+        probs = torch.empty(b, max_new_tokens, dtype=torch.float, device=idx.device) if return_probs else None
+        start = 0
+        steps = self.generate_generator(
+            idx,
+            max_new_tokens,
+            temperature=temperature,
+            top_k=top_k,
+            window_stride=window_stride,
+            return_probs=return_probs,
+        )
+        for step, sampled in enumerate(steps):
+            if return_probs:
+                tokens[:, step] = sampled[0][:, 0]
+                probs[:, step] = sampled[1][:, 0]
+            else:
+                tokens[:, step] = sampled[:, 0]
+            if step + 1 - start == chunk_size or step + 1 == max_new_tokens:
+                chunk = tokens[:, start:step + 1].tolist()
+                if return_probs:
+                    yield chunk, probs[:, start:step + 1].tolist()
+                else:
+                    yield chunk
+                start = step + 1
+
+    @staticmethod
+    def sample_logits_rows(logits, temperature, top_k):
+        """
+        Like sample_logits, with a temperature (float tensor (b,)) and top_k
+        (long tensor (b,), vocab_size for no cropping) per row.
+        """
+        logits = logits / temperature[:, None]
+        vocab_size = logits.size(-1)
+        if int(top_k.min()) < vocab_size:
+            # only the rows that crop run the topk, the others keep every logit
+            rows = (top_k < vocab_size).nonzero()[:, 0]
+            v, _ = torch.topk(logits[rows], int(top_k[rows].max()))
+            threshold = logits.new_full((logits.size(0), 1), -float('Inf'))
+            threshold[rows] = v.gather(1, top_k[rows, None] - 1)
+            logits = logits.masked_fill(logits < threshold, -float('Inf'))
+        probs = F.softmax(logits, dim=-1)
+        return torch.multinomial(probs, num_samples=1)
+
+    @torch.no_grad()
+    def generate_batch(self, prompts, max_new_tokens, temperature=1.0, top_k=None, stop_tokens=None):
+        """
+        Generate continuations for a batch of prompts of different lengths, see
+        generate_batch_generator. Returns the generated tokens of every prompt.
+        """
+        results = [[] for _ in prompts]
+        for rows, tokens in self.generate_batch_generator(prompts, max_new_tokens, temperature, top_k, stop_tokens):
+            for row, token in zip(rows, tokens):
+                results[row].append(token)
+        return results
+
     @torch.no_grad()
-    def generate_generator(self, idx, max_new_tokens, temperature=1.0, top_k=None):
+    def generate_batch_generator(self, prompts, max_new_tokens, temperature=1.0, top_k=None, stop_tokens=None):
+        """
+        Generate for a list of token lists of different lengths in one batch.
+        max_new_tokens, temperature, top_k and stop_tokens (a collection of ids
+        ending the row, the stop token is still emitted) are either one value
+        for all rows or a list with one value per row; a flat collection of ids
+        as stop_tokens is shared by all rows. Prompts are left-padded,
+        padding is masked out of the attention and the positions of every row
+        start at 0, so each row samples from the same distribution as when
+        generated alone. Finished rows drop out of the batch. The longest prompt
+        plus the largest max_new_tokens must fit into block_size.
+        Yields (rows, tokens) per step: the indices of the prompts still
+        active and the token sampled for each of them.
+        """
+        def per_row(value):
+            return list(value) if isinstance(value, (list, tuple)) else [value] * len(prompts)
+        max_new_tokens = per_row(max_new_tokens)
+        temperature = per_row(temperature)
+        top_k = [min(k, self.config.vocab_size) if k is not None else self.config.vocab_size for k in per_row(top_k)]
+        if stop_tokens is None:
+            stop_tokens = [set() for _ in prompts]
+        elif isinstance(stop_tokens, (list, tuple)) and stop_tokens and isinstance(stop_tokens[0], (list, tuple, set, frozenset)):
+            # one collection of ids per row
+            stop_tokens = [set(stop) for stop in stop_tokens]
+        else:
+            # one collection of ids for all rows
+            stop_tokens = [set(stop_tokens)] * len(prompts)
+        assert len(stop_tokens) == len(prompts), "stop_tokens needs one collection per prompt"
+        rows = [row for row in range(len(prompts)) if max_new_tokens[row] > 0]
+        if not rows:
+            return
+        assert all(len(prompts[row]) > 0 for row in rows), "prompts must not be empty"
+        prompt_length = max(len(prompts[row]) for row in rows)
+        total_length = prompt_length + max(max_new_tokens[row] for row in rows)
+        if total_length > self.config.block_size:
+            raise ValueError(f"longest prompt plus max_new_tokens is {total_length}, block size is only {self.config.block_size}")
+
+        device = next(self.parameters()).device
+        idx = torch.zeros(len(rows), prompt_length, dtype=torch.long)
+        for i, row in enumerate(rows):
+            idx[i, prompt_length - len(prompts[row]):] = torch.tensor(prompts[row], dtype=torch.long)
+        idx = idx.to(device)
+        pad = torch.tensor([prompt_length - len(prompts[row]) for row in rows], device=device)
+        slots = torch.arange(total_length, device=device)
+        # key_valid[i, slot]: the slot holds a real token of row i
+        key_valid = slots[None, :] >= pad[:, None]
+        temperature = torch.tensor([temperature[row] for row in rows], dtype=torch.float, device=device)
+        top_k = torch.tensor([top_k[row] for row in rows], dtype=torch.long, device=device)
+        generated = [0] * len(prompts)
+
+        kv_cache = KVCache(self.config, max_length=total_length)
         ctx = self.config.ctx or nullcontext()
+        # prefill; padding queries attend to themselves only, to stay finite
+        pos = (slots[None, :prompt_length] - pad[:, None]).clamp(min=0)
+        causal = torch.ones(prompt_length, prompt_length, dtype=torch.bool, device=device).tril()
+        attn_mask = (causal[None] & key_valid[:, None, :prompt_length]) | torch.eye(prompt_length, dtype=torch.bool, device=device)
+        # the autocast context is only entered around the forwards, never across a yield
         with ctx:
-            for _ in range(max_new_tokens):
-                # if the sequence context is growing too long we must crop it at block_size
-                idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -self.config.block_size:]
-                # forward the model to get the logits for the index in the sequence
-                logits, _ = self(idx_cond)
-                # pluck the logits at the final step and scale by desired temperature
-                logits = logits[:, -1, :] / temperature
-                # optionally crop the logits to only the top k options
-                if top_k is not None:
-                    v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
-                    logits[logits < v[:, [-1]]] = -float('Inf')
-                # apply softmax to convert logits to (normalized) probabilities
-                probs = F.softmax(logits, dim=-1)
-                # sample from the distribution
-                idx_next = torch.multinomial(probs, num_samples=1)
-                # append sampled index to the running sequence and continue
-                idx = torch.cat((idx, idx_next), dim=1)
-                yield idx_next
+            logits, _ = self(idx, kv_cache=kv_cache, pos=pos, attn_mask=attn_mask[:, None])
+        while True:
+            idx_next = self.sample_logits_rows(logits[:, -1, :], temperature, top_k)
+            tokens = idx_next[:, 0].tolist()
+            yield rows, tokens
+            running = []
+            for i, (row, token) in enumerate(zip(rows, tokens)):
+                generated[row] += 1
+                if generated[row] < max_new_tokens[row] and token not in stop_tokens[row]:
+                    running.append(i)
+            if not running:
+                return
+            if len(running) < len(rows):
+                # drop finished rows from the batch
+                selected = torch.tensor(running, device=device)
+                kv_cache.select(selected)
+                idx_next = idx_next[selected]
+                pad = pad[selected]
+                key_valid = key_valid[selected]
+                temperature = temperature[selected]
+                top_k = top_k[selected]
+                rows = [rows[i] for i in running]
+            # forward the sampled tokens of the remaining rows
+            slot = kv_cache.length
+            with ctx:
+                logits, _ = self(idx_next, kv_cache=kv_cache, pos=slot - pad[:, None], attn_mask=key_valid[:, None, None, :slot + 1])
+
+class StackedGPT:
+    """
+    N models with the same GPTConfig run as one: their parameters are stacked
+    into (N, ...) tensors, so each layer is a single batched matmul for all
+    models instead of N separate ones. The members' own parameters are
+    replaced by views into the stacks and keep working as before without
+    extra memory. Members with reverse set (anticausal models) are fed the
+    reversed input.
+    """
+
+    def __init__(self, models, reverse=None):
+        self.config = models[0].config
+        assert all(model.config == self.config for model in models), "stacked models need the same config"
+        self.n = len(models)
+        self.params = {}
+        # named_parameters skips the lm_head weight, it is tied to wte
+        for name, _ in models[0].named_parameters():
+            stacked = torch.stack([model.get_parameter(name).detach() for model in models])
+            self.params[name] = stacked
+            for i, model in enumerate(models):
+                model.get_parameter(name).data = stacked[i]
+        device = self.params['transformer.wte.weight'].device
+        self.reverse = torch.tensor(reverse or [False] * self.n, dtype=torch.bool, device=device)
+
+    def linear(self, x, name):
+        # x (n, b, t, in) -> (n, b, t, out)
+        n, b, t, _ = x.size()
+        y = torch.matmul(x.reshape(n, b * t, -1), self.params[name + '.weight'].transpose(1, 2))
+        if name + '.bias' in self.params:
+            y = y + self.params[name + '.bias'][:, None]
+        return y.view(n, b, t, -1)
+
+    def layer_norm(self, x, name):
+        x = F.layer_norm(x, x.shape[-1:], eps=1e-5) * self.params[name + '.weight'][:, None, None]
+        if name + '.bias' in self.params:
+            x = x + self.params[name + '.bias'][:, None, None]
+        return x
+
+    def attention(self, x, name):
+        n, b, t, c = x.size()
+        nh = self.config.n_head
+        q, k, v = self.linear(x, name + '.c_attn').split(c, dim=3)
+        q = q.reshape(n * b, t, nh, c // nh).transpose(1, 2) # (n * b, nh, t, hs)
+        k = k.reshape(n * b, t, nh, c // nh).transpose(1, 2)
+        v = v.reshape(n * b, t, nh, c // nh).transpose(1, 2)
+        y = F.scaled_dot_product_attention(q, k, v, is_causal=True)
+        y = y.transpose(1, 2).reshape(n, b, t, c)
+        return self.linear(y, name + '.c_proj')
+
+    def mlp(self, x, name):
+        return self.linear(F.gelu(self.linear(x, name + '.c_fc')), name + '.c_proj')
+
+    def inputs(self, idx):
+        # idx (b, t) -> (n, b, t), as seen by each member
+        return torch.where(self.reverse[:, None, None], idx.flip(1), idx)
+
+    def hidden_states(self, idx):
+        b, t = idx.size()
+        assert t <= self.config.block_size, f"Cannot forward sequence of length {t}, block size is only {self.config.block_size}"
+        members = torch.arange(self.n, device=idx.device)[:, None, None]
+        x = self.params['transformer.wte.weight'][members, self.inputs(idx)] # (n, b, t, n_embd)
+        x = x + self.params['transformer.wpe.weight'][:, None, :t]
+        for i in range(self.config.n_layer):
+            x = x + self.attention(self.layer_norm(x, f'transformer.h.{i}.ln_1'), f'transformer.h.{i}.attn')
+            x = x + self.mlp(self.layer_norm(x, f'transformer.h.{i}.ln_2'), f'transformer.h.{i}.mlp')
+        return self.layer_norm(x, 'transformer.ln_f')
+
+    def lm_head(self, x):
+        # (n, b, t, n_embd) -> (n, b, t, vocab_size)
+        return torch.matmul(x, self.params['transformer.wte.weight'].transpose(1, 2)[:, None])
+
+    @torch.no_grad()
+    def forward(self, idx, return_all_logits=False):
+        """ The logits of every member for idx (b, t), shape (n, b, t or 1, vocab_size) """
+        x = self.hidden_states(idx)
+        if not return_all_logits:
+            x = x[:, :, [-1]]
+        return self.lm_head(x)
+
+    __call__ = forward
+
+    @torch.no_grad()
+    def score(self, idx, chunk_size=128):
+        """
+        Log-probs (n, b, t - 1) of every token of idx after the first given the
+        ones before it, in each member's reading direction. The lm_head runs
+        over chunks of chunk_size positions to bound the memory.
+        """
+        x = self.hidden_states(idx)[:, :, :-1]
+        targets = self.inputs(idx)[:, :, 1:]
+        log_probs = []
+        for start in range(0, x.size(2), chunk_size):
+            chunk = F.log_softmax(self.lm_head(x[:, :, start:start + chunk_size]).float(), dim=-1)
+            log_probs.append(chunk.gather(3, targets[:, :, start:start + chunk_size, None])[..., 0])
+        return torch.cat(log_probs, dim=2)
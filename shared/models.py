@@ -8,9 +8,11 @@ class BaseRequest(BaseModel):
 
 class InferenceConfig(BaseModel):
     num_tokens: int = Field(default=200)
-    temperature: float = Field(default=0.8)
-    top_k: int = Field(default=200)
+    temperature: float = Field(default=0.8, gt=0)
+    top_k: int = Field(default=200, gt=0)
     synthetic_wait: float = Field(default=0.0)
+    # also stream the generated text, decoded incrementally on the server
+    stream_text: bool = Field(default=False)
 
 
 class InferenceRequest(BaseModel):
@@ -34,17 +36,27 @@ class InferenceResponse(BaseModel):
     type: Literal["autoregressiveInference"]
     request_id: str
     tokens: list[int]
+    # newly finalized text if stream_text was requested; for anticausal
+    # models it precedes the text of all earlier responses
+    text: Optional[str] = None
     done: bool = False
 
 
 class LogitsRequest(BaseModel):
     token_input: list[int]
+    # only return the top_k most likely tokens with their log-probs
+    top_k: Optional[int] = Field(default=None, gt=0)
 
 
 class LogitsResponse(BaseModel):
     logits: list[float]
 
 
+class LogitsTopKResponse(BaseModel):
+    token_ids: list[int]
+    log_probs: list[float]
+
+
 class GeminiColumnRequest(BaseModel):
     path: list[str]
 
@@ -84,3 +96,55 @@ class ForcingTokenStep(BaseModel):
 class ForcingResponse(BaseModel):
     total_logprob: float
     steps: list[ForcingTokenStep]
+
+
+class PrefixCacheStats(BaseModel):
+    hit_rate: float
+    hit_tokens: int
+    miss_tokens: int
+    bytes: int
+    max_bytes: int
+    entries: int
+
+
+class CompareRequest(BaseModel):
+    token_input: list[int]
+    model_ids: list[str]
+    top_k: int = Field(default=20, gt=0)
+
+
+class CompareModelResult(BaseModel):
+    # log-prob of the input in the model's reading direction
+    total_logprob: float
+    # the most likely next tokens, for anticausal models the ones preceding the input
+    alternatives: list[ForcingAlternativeToken]
+
+
+class CompareResponse(BaseModel):
+    results: dict[str, CompareModelResult]
+
+
+class BatchingStats(BaseModel):
+    queue_depth: int
+    requests: int
+    batches: int
+    mean_batch_size: float
+    max_batch_size: int
+    last_batch_size: int
+    batch_sizes: dict[int, int]
+
+
+class GenerationEngineStats(BaseModel):
+    running: int
+    waiting: int
+    sequences: int
+    steps: int
+    tokens: int
+    mean_batch_size: float
+    max_batch_size: int
+
+
+class DeviceExecutorStats(BaseModel):
+    pending: int
+    completed: int
+    rejected: int
@@ -1,7 +1,90 @@
 import base64
+import bisect
+import codecs
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import sys
 from dataclasses import dataclass
+from collections import OrderedDict
+from collections.abc import Sequence
 from typing import List, Optional, Dict, Tuple, Iterable
 
+import numpy as np
+
+COMPILED_MAGIC = b'DEVOCAB1'
+COMPILED_SUFFIX = '.bin'
+COMPILED_ALIGNMENT = 64
+# below this many ids a plain join is faster than the vectorized gather
+SMALL_DECODE_LENGTH = 8
+
+@dataclass
+class EncodeCacheInfo:
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+@dataclass
+class EncodingWithOffsets:
+    ids: List[int]
+    byte_offsets: List[Tuple[int, int]]
+    char_offsets: List[Tuple[int, int]]
+
+@dataclass
+class MergeTrace:
+    """
+    All intermediate states of one encoding. Step i applies merge rule
+    rules[i] at merges[i], a list of (left, right) byte offsets: every token
+    is identified by the offset of its first byte, the right token is removed
+    and the left one becomes rules[i]. Merge rules are applied in ascending
+    order, so the state after step i equals
+    encode(text, last_applied_merge_rule=rules[i]).
+    """
+    byte_values: List[int]
+    rules: List[int]
+    merges: List[List[Tuple[int, int]]]
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def states(self) -> Iterable[List[int]]:
+        """ Token ids before the first and after every step. """
+        values = list(self.byte_values)
+        next_ = list(range(1, len(values) + 1))
+        yield self.collect(values, next_)
+        for rule, merges in zip(self.rules, self.merges):
+            for left, right in merges:
+                values[left] = rule
+                next_[left] = next_[right]
+            yield self.collect(values, next_)
+
+    def state(self, step: int) -> List[int]:
+        """ Token ids after the first step steps (0: the raw bytes). """
+        values = list(self.byte_values)
+        next_ = list(range(1, len(values) + 1))
+        for rule, merges in zip(self.rules[:step], self.merges[:step]):
+            for left, right in merges:
+                values[left] = rule
+                next_[left] = next_[right]
+        return self.collect(values, next_)
+
+    def state_at_rule(self, last_applied_merge_rule: int) -> List[int]:
+        """ Same as encode(text, last_applied_merge_rule=last_applied_merge_rule). """
+        return self.state(bisect.bisect_right(self.rules, last_applied_merge_rule))
+
+    @staticmethod
+    def collect(values: List[int], next_: List[int]) -> List[int]:
+        result = []
+        current = 0
+        while current < len(values):
+            result.append(values[current])
+            current = next_[current]
+        return result
+
 @dataclass
 class MergeRule:
     left: 'Token'
@@ -45,22 +128,47 @@ class LinkedList:
 
 
 class Token:
-    def __init__(self, index: int, value: bytes, vocab: Optional['Vocabulary'] = None):
+    """
+    View on one row of a Vocabulary's token table. Token objects are created
+    on access and hold nothing but their index and vocabulary, everything
+    else is looked up in the vocabulary's arrays.
+    """
+    __slots__ = ('index', 'vocab')
+
+    def __init__(self, index: int, vocab: 'Vocabulary'):
         self.index = index
-        self.value = value
         self.vocab = vocab
-        self.composition: Optional[tuple[Token, Token]] = None
-        self.children: tuple[list[Token], list[Token]] = ([], [])
 
+    @property
+    def value(self) -> bytes:
+        return self.vocab.token_value(self.index)
+
+    @property
+    def display_string(self) -> str:
         try:
-            self.display_string = value.decode('utf-8')
+            return self.value.decode('utf-8')
         except UnicodeDecodeError:
-            self.display_string = f'<{self.index}>'
+            return f'<{self.index}>'
+
+    @property
+    def composition(self) -> Optional[tuple['Token', 'Token']]:
+        if self.index < 256:
+            return None
+        left, right = self.vocab.arrays['merges'][self.index - 256].tolist()
+        return (Token(left, self.vocab), Token(right, self.vocab))
+
+    @property
+    def children(self) -> tuple[list['Token'], list['Token']]:
+        return (
+            self.vocab.child_tokens(self.index, 'left'),
+            self.vocab.child_tokens(self.index, 'right'),
+        )
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Token) and self.vocab is other.vocab and self.index == other.index
 
-        if vocab is not None:
-            assert len(vocab.tokens) == index
-            vocab.tokens.append(self)
-            vocab.display_set[self.display_string] = self
+    def __hash__(self) -> int:
+        return hash((id(self.vocab), self.index))
 
     def id(self) -> int:
         return self.index
@@ -79,16 +187,16 @@ class Token:
         )
 
     def history_tree(self) -> dict:
-        assert self.vocab is not None, 'No vocabulary for token'
-        if self.composition is None:
+        composition = self.composition
+        if composition is None:
             return {'name': self.display_string, 'id': self.index}
         else:
             return {
                 'name': self.display_string.replace(' ', '⎵').replace('\n', '\\n'),
                 'id': self.index,
                 'children': [
-                    self.composition[0].history_tree(),
-                    self.composition[1].history_tree()
+                    composition[0].history_tree(),
+                    composition[1].history_tree()
                 ]
             }
 
@@ -96,27 +204,184 @@ class Token:
         return self.index < 256
 
 
+class TokenTable(Sequence):
+    """ Sequence of all tokens of a vocabulary, creating Token views on access. """
+
+    def __init__(self, vocab: 'Vocabulary'):
+        self.vocab = vocab
+
+    def __len__(self) -> int:
+        return self.vocab.num_tokens
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [Token(i, self.vocab) for i in range(*index.indices(len(self)))]
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('token index out of range')
+        return Token(index, self.vocab)
+
+
+class MergeRuleTable(Sequence):
+    """ Sequence of all merge rules of a vocabulary, creating MergeRules on access. """
+
+    def __init__(self, vocab: 'Vocabulary'):
+        self.vocab = vocab
+
+    def __len__(self) -> int:
+        return self.vocab.num_tokens - 256
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('merge rule index out of range')
+        left, right = self.vocab.arrays['merges'][index].tolist()
+        return MergeRule(
+            left=Token(left, self.vocab),
+            right=Token(right, self.vocab),
+            result=Token(index + 256, self.vocab),
+        )
+
+
+def compile_merge_rules(merge_rules: List[Tuple[int, int]]) -> Dict[str, np.ndarray]:
+    """
+    Turn a list of merge rules into the flat arrays backing a Vocabulary:
+    token byte blob and offsets, merge pairs, a sorted merge-rank lookup and
+    the child adjacency of every token (CSR, in merge order).
+    """
+    num_merges = len(merge_rules)
+    num_tokens = 256 + num_merges
+    merges = np.array(merge_rules, dtype='<u4').reshape(num_merges, 2)
+    if np.any(merges >= np.arange(256, num_tokens, dtype='<u4')[:, None]):
+        raise AssertionError('Merge rule on unknown token')
+
+    values = [bytes([index]) for index in range(256)]
+    for left, right in merge_rules:
+        values.append(values[left] + values[right])
+    token_offsets = np.zeros(num_tokens + 1, dtype='<u4')
+    np.cumsum([len(value) for value in values], out=token_offsets[1:])
+    token_bytes = np.frombuffer(b''.join(values), dtype=np.uint8)
+
+    # if a pair occurs twice, the later rule wins, like in a dict
+    keys = (merges[:, 0].astype('<u8') << 32) | merges[:, 1]
+    merge_keys, last_occurrence = np.unique(keys[::-1], return_index=True)
+    merge_key_ranks = (num_tokens - 1 - last_occurrence).astype('<u4')
+
+    arrays = {
+        'token_offsets': token_offsets,
+        'token_bytes': token_bytes,
+        'merges': merges,
+        'merge_keys': merge_keys.astype('<u8'),
+        'merge_key_ranks': merge_key_ranks,
+    }
+    for side, name in enumerate(('left', 'right')):
+        order = np.argsort(merges[:, side], kind='stable')
+        arrays[f'{name}_children'] = (order + 256).astype('<u4')
+        child_offsets = np.zeros(num_tokens + 1, dtype='<u4')
+        np.cumsum(np.bincount(merges[:, side], minlength=num_tokens), out=child_offsets[1:])
+        arrays[f'{name}_child_offsets'] = child_offsets
+    return arrays
+
+
+def save_compiled(arrays: Dict[str, np.ndarray], filename: str):
+    """
+    Write compiled vocabulary arrays as: magic, header length (u4), JSON header
+    with dtype, shape and offset of every array, then the raw arrays, each
+    aligned to COMPILED_ALIGNMENT bytes.
+    """
+    entries = {}
+    offset = 0
+    for name, array in arrays.items():
+        offset = -(-offset // COMPILED_ALIGNMENT) * COMPILED_ALIGNMENT
+        entries[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += array.nbytes
+    header = json.dumps(entries).encode('utf-8')
+    preamble = COMPILED_MAGIC + len(header).to_bytes(4, 'little') + header
+    data_start = -(-len(preamble) // COMPILED_ALIGNMENT) * COMPILED_ALIGNMENT
+    with open(filename, 'wb') as f:
+        f.write(preamble.ljust(data_start, b'\0'))
+        for name, array in arrays.items():
+            f.seek(data_start + entries[name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+
+
+def load_compiled(filename: str) -> Dict[str, np.ndarray]:
+    """ Memory-map a file written by save_compiled, the arrays are read-only views. """
+    with open(filename, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buffer[:len(COMPILED_MAGIC)] != COMPILED_MAGIC:
+        raise ValueError(f'Not a compiled vocabulary: {filename}')
+    header_start = len(COMPILED_MAGIC) + 4
+    header_length = int.from_bytes(buffer[len(COMPILED_MAGIC):header_start], 'little')
+    entries = json.loads(buffer[header_start:header_start + header_length])
+    data_start = -(-(header_start + header_length) // COMPILED_ALIGNMENT) * COMPILED_ALIGNMENT
+    arrays = {}
+    for name, entry in entries.items():
+        shape = tuple(entry['shape'])
+        arrays[name] = np.frombuffer(
+            buffer,
+            dtype=np.dtype(entry['dtype']),
+            count=math.prod(shape),
+            offset=data_start + entry['offset'],
+        ).reshape(shape)
+    return arrays
+
+
 class Vocabulary:
     def __init__(self, merge_rules: List[Tuple[int, int]]):
-        self.tokens: List[Token] = []
-        self.merge_rules: List[MergeRule] = []
-        self.display_set: Dict[str, Token] = {}
-
-        while len(self.tokens) < 256:
-            self.mint_byte_token()
-
-        for left_idx, right_idx in merge_rules:
-            if left_idx >= len(self.tokens) or right_idx >= len(self.tokens):
-                raise AssertionError('Merge rule on unknown token')
-            left = self.tokens[left_idx]
-            right = self.tokens[right_idx]
-            if left is None or right is None:
-                raise AssertionError('Merge rule on unknown token')
-            token = self.mint_merged_token(left, right)
-            token.composition = (left, right)
-            left.children[0].append(token)
-            right.children[1].append(token)
-            self.merge_rules.append(MergeRule(left=left, right=right, result=token))
+        self.init_arrays(compile_merge_rules(merge_rules))
+
+    def init_arrays(self, arrays: Dict[str, np.ndarray]):
+        self.arrays = arrays
+        self.num_tokens = len(arrays['token_offsets']) - 1
+        self.token_offsets = arrays['token_offsets']
+        self.token_bytes = memoryview(arrays['token_bytes'])
+        self.tokens = TokenTable(self)
+        self.merge_rules = MergeRuleTable(self)
+        self._display_set: Optional[Dict[str, Token]] = None
+        self._merge_ranks: Optional[Dict[Tuple[int, int], int]] = None
+        self._token_strings: Optional[List[str]] = None
+        self._token_matches: Dict[object, np.ndarray] = {}
+        self._token_masks: Dict[tuple, object] = {}
+        self.set_encode_cache(0)
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> 'Vocabulary':
+        vocab = cls.__new__(cls)
+        vocab.init_arrays(arrays)
+        return vocab
+
+    @property
+    def display_set(self) -> Dict[str, Token]:
+        if self._display_set is None:
+            self._display_set = {token.display_string: token for token in self.tokens}
+        return self._display_set
+
+    @property
+    def merge_ranks(self) -> Dict[Tuple[int, int], int]:
+        if self._merge_ranks is None:
+            keys = self.arrays['merge_keys']
+            self._merge_ranks = dict(zip(
+                zip((keys >> 32).tolist(), (keys & 0xffffffff).tolist()),
+                self.arrays['merge_key_ranks'].tolist(),
+            ))
+        return self._merge_ranks
+
+    def child_tokens(self, index: int, side: str) -> List[Token]:
+        """ Tokens merged from this token as their left or right part, in merge order. """
+        offsets = self.arrays[f'{side}_child_offsets']
+        children = self.arrays[f'{side}_children'][offsets[index]:offsets[index + 1]]
+        return [Token(child, self) for child in children.tolist()]
+
+    def token_value(self, index: int) -> bytes:
+        start, end = self.token_offsets[index:index + 2].tolist()
+        return bytes(self.token_bytes[start:end])
 
     @classmethod
     def from_base64(cls, base64_str: str) -> 'Vocabulary':
@@ -156,29 +421,295 @@ class Vocabulary:
 
     @classmethod
     def load(cls, filename: str) -> "Vocabulary":
+        """
+        Load a .vocab file. If a compiled sibling (filename + COMPILED_SUFFIX)
+        exists and is not older than the text file, it is memory-mapped instead.
+        """
+        compiled = filename + COMPILED_SUFFIX
+        if os.path.exists(compiled) and (
+            not os.path.exists(filename)
+            or os.path.getmtime(compiled) >= os.path.getmtime(filename)
+        ):
+            return cls.load_compiled(compiled)
         with open(filename, "r") as f:
             return cls.from_vocab_file(f.read())
 
-    def mint_byte_token(self) -> Token:
-        index = len(self.tokens)
-        value = bytes([index])
-        return Token(index, value, self)
-
-    def mint_merged_token(self, left: Token, right: Token) -> Token:
-        index = len(self.tokens)
-        merged_value = left.value + right.value
-        return Token(index, merged_value, self)
+    @classmethod
+    def load_compiled(cls, filename: str) -> "Vocabulary":
+        return cls.from_arrays(load_compiled(filename))
+
+    def save_compiled(self, filename: str):
+        save_compiled(self.arrays, filename)
+
+    @property
+    def token_strings(self) -> List[str]:
+        """ decode([i]) for every token i, computed once. """
+        if self._token_strings is None:
+            self._token_strings = self.decode_batch(np.arange(self.num_tokens)[:, None])
+        return self._token_strings
+
+    def match_tokens(self, predicate) -> np.ndarray:
+        """
+        Boolean array telling which tokens match predicate, which is either a
+        regex (str or compiled, applied with re.match to the decoded token) or a
+        callable taking the decoded token. Cached per predicate.
+        """
+        if predicate not in self._token_matches:
+            if isinstance(predicate, (str, re.Pattern)):
+                test = re.compile(predicate).match
+            else:
+                test = predicate
+            self._token_matches[predicate] = np.fromiter(
+                (bool(test(string)) for string in self.token_strings),
+                dtype=bool,
+                count=self.num_tokens,
+            )
+        return self._token_matches[predicate]
+
+    def token_mask(self, predicate, size: Optional[int] = None, device="cpu", exclude=False, additive=True):
+        """
+        Logit mask tensor of length size (default: number of tokens) for the
+        tokens matching predicate (see match_tokens), or not matching it if
+        exclude is set. The additive mask is 0 for allowed tokens and -inf
+        otherwise, the boolean one is True for allowed tokens. Ids beyond the
+        vocabulary (padding up to the model's vocab_size) are left allowed.
+        Masks are cached per (predicate, size, device, ...) on the vocabulary
+        and shared between callers, so they must not be modified in place.
+        """
+        import torch
+
+        if size is None:
+            size = self.num_tokens
+        key = (predicate, size, str(device), exclude, additive)
+        if key not in self._token_masks:
+            allowed = self.match_tokens(predicate)
+            if exclude:
+                allowed = ~allowed
+            allowed_tensor = torch.ones(size, dtype=torch.bool)
+            allowed_tensor[:self.num_tokens] = torch.from_numpy(allowed[:size])
+            if additive:
+                mask = torch.zeros(size)
+                mask[~allowed_tensor] = -float('inf')
+            else:
+                mask = allowed_tensor
+            self._token_masks[key] = mask.to(device)
+        return self._token_masks[key]
+
+    def set_encode_cache(self, maxsize: int):
+        """
+        Enable an LRU cache of encode results with at most maxsize entries,
+        keyed by (input, reverse, last_applied_merge_rule). 0 disables it.
+        """
+        self.encode_cache = OrderedDict() if maxsize > 0 else None
+        self.encode_cache_maxsize = maxsize
+        self.encode_cache_hits = 0
+        self.encode_cache_misses = 0
+
+    def encode_cache_info(self) -> EncodeCacheInfo:
+        return EncodeCacheInfo(
+            hits=self.encode_cache_hits,
+            misses=self.encode_cache_misses,
+            maxsize=self.encode_cache_maxsize,
+            currsize=len(self.encode_cache) if self.encode_cache is not None else 0,
+        )
 
     def encode(self, input_str: str, reverse=False, last_applied_merge_rule: Optional[int] = None, add_eot: bool = False) -> List[int]:
-        inf = len(self.tokens) * 2
+        cache = self.encode_cache
+        if cache is None:
+            result = self.encode_merges(input_str, last_applied_merge_rule)
+            if reverse:
+                result.reverse()
+        else:
+            key = (input_str, reverse, last_applied_merge_rule)
+            cached = cache.get(key)
+            if cached is not None:
+                cache.move_to_end(key)
+                self.encode_cache_hits += 1
+            else:
+                self.encode_cache_misses += 1
+                result = self.encode_merges(input_str, last_applied_merge_rule)
+                if reverse:
+                    result.reverse()
+                cached = tuple(result)
+                cache[key] = cached
+                if len(cache) > self.encode_cache_maxsize:
+                    cache.popitem(last=False)
+            result = list(cached)
+        if add_eot:
+            result = [0xff] + result
+        return result
+
+    def encode_with_offsets(self, input_str: str, reverse=False, last_applied_merge_rule: Optional[int] = None, add_eot: bool = False) -> EncodingWithOffsets:
+        """
+        Like encode, but also returns the [start, end) span of every token in
+        input_str, in bytes and in characters. Byte spans come from the merge
+        process itself. A token that starts or ends inside a multi-byte
+        character covers that whole character in its character span.
+        With reverse the spans are reversed along with the ids, and the eot
+        token gets an empty span at the end (reverse) or start of the text.
+        """
+        data = input_str.encode('utf-8')
+        starts: List[int] = []
+        ids = self.encode_merges(data, last_applied_merge_rule, starts=starts)
+        byte_starts = np.array(starts, dtype=np.int64)
+        byte_ends = np.append(byte_starts[1:], len(data))[:len(byte_starts)]
+        # characters_before[i]: number of characters starting at a byte < i
+        is_char_start = (np.frombuffer(data, dtype=np.uint8) & 0xc0) != 0x80
+        characters_before = np.zeros(len(data) + 1, dtype=np.int64)
+        np.cumsum(is_char_start, out=characters_before[1:])
+        char_starts = characters_before[byte_starts + 1] - 1
+        char_ends = characters_before[byte_ends]
+        byte_offsets = list(zip(byte_starts.tolist(), byte_ends.tolist()))
+        char_offsets = list(zip(char_starts.tolist(), char_ends.tolist()))
+        if reverse:
+            ids.reverse()
+            byte_offsets.reverse()
+            char_offsets.reverse()
+        if add_eot:
+            ids = [0xff] + ids
+            byte_offsets = [(len(data), len(data)) if reverse else (0, 0)] + byte_offsets
+            char_offsets = [(len(input_str), len(input_str)) if reverse else (0, 0)] + char_offsets
+        return EncodingWithOffsets(ids=ids, byte_offsets=byte_offsets, char_offsets=char_offsets)
+
+    def encode_many(self, inputs: Iterable[str], **kwargs) -> List[List[int]]:
+        """ encode every input, encoding each distinct string only once. """
+        inputs = list(inputs)
+        unique = {input_str: self.encode(input_str, **kwargs) for input_str in dict.fromkeys(inputs)}
+        return [list(unique[input_str]) for input_str in inputs]
+
+    def encode_incremental(self, prev_text: str, prev_ids: List[int], appended_text: str) -> List[int]:
+        """
+        Encode prev_text + appended_text, given prev_ids == encode(prev_text).
+        Only a suffix of prev_ids is re-encoded together with the appended text.
+
+        A token boundary in prev_ids was never crossed by a merge, so the prefix
+        before it encodes on its own to the same ids. The boundary also holds
+        for the new text unless some merge joins a token on the right spine of
+        the last kept token (the tokens that covered its last byte while it was
+        built) with one on the left spine of the first re-encoded token. If no
+        such merge rule exists the result equals a full encode, otherwise the
+        split point moves further back.
+        """
+        if not prev_ids:
+            return self.encode(prev_text + appended_text)
+        merges = self.arrays['merges']
+        merge_ranks = self.merge_ranks
+        appended = appended_text.encode('utf-8')
+        keep = len(prev_ids) - 1
+        step = 1
+        while keep > 0:
+            suffix = self.encode_merges(self.decode_bytes(prev_ids[keep:]) + appended)
+            if not suffix:
+                return list(prev_ids[:keep])
+            right_spine = self.spine(prev_ids[keep - 1], 1, merges)
+            left_spine = self.spine(suffix[0], 0, merges)
+            if not any((left, right) in merge_ranks for left in right_spine for right in left_spine):
+                return list(prev_ids[:keep]) + suffix
+            keep = max(keep - step, 0)
+            step *= 2
+        return self.encode(prev_text + appended_text)
+
+    @staticmethod
+    def spine(token_id: int, side: int, merges: np.ndarray) -> List[int]:
+        """ token_id followed by its left (side 0) or right (side 1) parts down to a byte. """
+        spine = [int(token_id)]
+        while spine[-1] >= 256:
+            spine.append(int(merges[spine[-1] - 256, side]))
+        return spine
+
+    def merge_trace(self, input_str: str) -> 'MergeTrace':
+        """ Record every intermediate BPE state of input_str in a single encoding pass. """
+        applied: List[Tuple[int, int, int]] = []
+        self.encode_merges(input_str, trace=applied)
+        trace = MergeTrace(byte_values=list(input_str.encode('utf-8')), rules=[], merges=[])
+        for rank, left, right in applied:
+            if not trace.rules or trace.rules[-1] != rank:
+                trace.rules.append(rank)
+                trace.merges.append([])
+            trace.merges[-1].append((left, right))
+        return trace
+
+    def encode_merges(
+        self,
+        input_str: str | bytes,
+        last_applied_merge_rule: Optional[int] = None,
+        trace: Optional[List[Tuple[int, int, int]]] = None,
+        starts: Optional[List[int]] = None,
+    ) -> List[int]:
+        """
+        Byte-pair encode input_str. Candidate pairs are kept in a heap keyed by
+        (merge rank, position), so the lowest-ranked, leftmost pair is always
+        merged next. Entries invalidated by a neighbouring merge are skipped when
+        popped. Runs in O(n log n) and produces the same output as encode_scan.
+        If trace is given, (rank, left position, right position) of every
+        applied merge is appended to it, positions being byte offsets. If
+        starts is given, the byte offset of every resulting token is appended.
+        """
+        if last_applied_merge_rule is None:
+            last_applied_merge_rule = self.num_tokens * 2
+        merge_ranks = self.merge_ranks
+
+        values = list(input_str.encode('utf-8') if isinstance(input_str, str) else input_str)
+        n = len(values)
+        # doubly linked list over byte positions; a merged node keeps the
+        # position of its left part, a removed node gets next = -2
+        prev = list(range(-1, n - 1))
+        next_ = list(range(1, n + 1))
+        if n:
+            next_[-1] = -1
+
+        heap = []
+        for i in range(n - 1):
+            rank = merge_ranks.get((values[i], values[i + 1]))
+            if rank is not None and rank <= last_applied_merge_rule:
+                heap.append((rank, i, i + 1))
+        heapq.heapify(heap)
+
+        while heap:
+            rank, left, right = heapq.heappop(heap)
+            if next_[left] != right or merge_ranks.get((values[left], values[right])) != rank:
+                continue
+
+            if trace is not None:
+                trace.append((rank, left, right))
+            values[left] = rank
+            after = next_[right]
+            next_[left] = after
+            next_[right] = -2
+            if after != -1:
+                prev[after] = left
+
+            before = prev[left]
+            if before != -1:
+                new_rank = merge_ranks.get((values[before], rank))
+                if new_rank is not None and new_rank <= last_applied_merge_rule:
+                    heapq.heappush(heap, (new_rank, before, left))
+            if after != -1:
+                new_rank = merge_ranks.get((rank, values[after]))
+                if new_rank is not None and new_rank <= last_applied_merge_rule:
+                    heapq.heappush(heap, (new_rank, left, after))
+
+        result = []
+        current = 0 if n else -1
+        while current != -1:
+            result.append(values[current])
+            if starts is not None:
+                starts.append(current)
+            current = next_[current]
+        return result
+
+    def encode_scan(self, input_str: str, reverse=False, last_applied_merge_rule: Optional[int] = None, add_eot: bool = False) -> List[int]:
+        """
+        Reference encoder: rescans the whole token list for the lowest-ranked
+        pair before every merge, which is quadratic in the input length.
+        """
+        inf = self.num_tokens * 2
         if last_applied_merge_rule is None:
             last_applied_merge_rule = +inf
 
         bytes_input = input_str.encode('utf-8')
         token_list = LinkedList.from_iterable(bytes_input)
-        reverse_merge_rules = {
-            (rule.left.id(), rule.right.id()): rule.result.id() for rule in self.merge_rules
-        }
+        reverse_merge_rules = self.merge_ranks
 
         while True:
             min_rule_id = +inf
@@ -219,21 +750,116 @@ class Vocabulary:
             result = [0xff] + result
         return result
 
-    def decode_bytes(self, token_ids: list[int], reverse=False) -> bytes:
+    def gather_bytes(self, token_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Gather the bytes of all tokens in a flat id array in one vectorized pass.
+        Returns the byte buffer and the cumulative byte offset of every token
+        (length len(token_ids) + 1).
+        """
+        starts = self.token_offsets[token_ids].astype(np.int64)
+        lengths = self.token_offsets[token_ids + 1].astype(np.int64) - starts
+        output_offsets = np.zeros(len(token_ids) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=output_offsets[1:])
+        positions = np.repeat(starts - output_offsets[:-1], lengths) + np.arange(output_offsets[-1])
+        return self.arrays['token_bytes'][positions], output_offsets
+
+    def decode_bytes(self, token_ids, reverse=False) -> bytes:
+        """
+        Decode a list or numpy array of token ids (any integer dtype or
+        endianness, e.g. a '>u2' memmap slice) to bytes.
+        """
+        if isinstance(token_ids, list) and len(token_ids) <= SMALL_DECODE_LENGTH:
+            if reverse:
+                token_ids = reversed(token_ids)
+            return b''.join(self.token_value(id_) for id_ in token_ids)
+        ids = np.asarray(token_ids).astype(np.intp).reshape(-1)
         if reverse:
-          return bytes(reversed(b''.join(
-              bytes(reversed(self.tokens[id_].value))
-              for id_ in token_ids
-          )))
-        else:
-            return b''.join(
-                self.tokens[id_].value
-                for id_ in token_ids
-            )
+            ids = ids[::-1]
+        return self.gather_bytes(ids)[0].tobytes()
 
-    def decode(self, token_ids: list[int], reverse=False) -> str:
+    def decode(self, token_ids, reverse=False) -> str:
         return self.decode_bytes(
             token_ids,
             reverse=reverse
         ).decode(errors="replace")
 
+    def decode_bytes_batch(self, windows, reverse=False) -> List[bytes]:
+        """
+        Decode many token windows at once, either a 2D array (one window per row)
+        or a sequence of 1D arrays/lists of possibly different lengths.
+        """
+        if isinstance(windows, np.ndarray) and windows.ndim == 2:
+            rows = windows[:, ::-1] if reverse else windows
+            window_lengths = np.full(len(rows), rows.shape[1], dtype=np.int64)
+            ids = rows.astype(np.intp).reshape(-1)
+        else:
+            rows = [np.asarray(window).astype(np.intp).reshape(-1) for window in windows]
+            if reverse:
+                rows = [row[::-1] for row in rows]
+            window_lengths = np.array([len(row) for row in rows], dtype=np.int64)
+            ids = np.concatenate(rows) if rows else np.zeros(0, dtype=np.intp)
+        buffer, token_offsets = self.gather_bytes(ids)
+        window_offsets = np.zeros(len(window_lengths) + 1, dtype=np.int64)
+        np.cumsum(window_lengths, out=window_offsets[1:])
+        byte_offsets = token_offsets[window_offsets].tolist()
+        data = buffer.tobytes()
+        return [data[start:end] for start, end in zip(byte_offsets, byte_offsets[1:])]
+
+    def decode_batch(self, windows, reverse=False) -> List[str]:
+        return [
+            window.decode(errors="replace")
+            for window in self.decode_bytes_batch(windows, reverse=reverse)
+        ]
+
+class IncrementalDecoder:
+    """
+    Stateful detokenizer for generation output. push() takes newly generated
+    token ids and returns only the text that became final, holding back
+    incomplete UTF-8 sequences. With reverse=True (anticausal output) every
+    token precedes the previous ones, so each returned piece has to be
+    prepended to the text received so far. Costs O(1) per token.
+    """
+
+    def __init__(self, vocab: Vocabulary, reverse=False):
+        self.vocab = vocab
+        self.reverse = reverse
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        # reverse mode only: leading continuation bytes whose lead byte is still to come
+        self.pending = b''
+
+    def push(self, token_ids) -> str:
+        if isinstance(token_ids, int):
+            token_ids = [token_ids]
+        if not self.reverse:
+            return self.decoder.decode(self.vocab.decode_bytes(list(token_ids)))
+        pieces = []
+        for id_ in token_ids:
+            pieces.append(self.push_reverse(self.vocab.token_value(int(id_))))
+        return ''.join(reversed(pieces))
+
+    def push_reverse(self, value: bytes) -> str:
+        data = value + self.pending
+        # hold back up to three leading continuation bytes, the bytes after
+        # them start at a character boundary and are complete to the right
+        hold = 0
+        while hold < 3 and hold < len(data) and 0x80 <= data[hold] < 0xc0:
+            hold += 1
+        self.pending = data[:hold]
+        return data[hold:].decode(errors='replace')
+
+    def finish(self) -> str:
+        """ Flush whatever is held back, incomplete sequences become replacement characters. """
+        if not self.reverse:
+            return self.decoder.decode(b'', final=True)
+        text = self.pending.decode(errors='replace')
+        self.pending = b''
+        return text
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python vocabulary.py <file.vocab> [...]")
+    for filename in sys.argv[1:]:
+        with open(filename, "r") as f:
+            vocab = Vocabulary.from_vocab_file(f.read())
+        vocab.save_compiled(filename + COMPILED_SUFFIX)
+        print(f"Compiled {vocab.num_tokens} tokens to {filename + COMPILED_SUFFIX}")